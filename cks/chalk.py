@@ -10,67 +10,409 @@ Copyright:  This code cannot be used, modified or re-distributed
 import pandas as pd
 from IPython.display import HTML
 pd.set_option('display.max_rows', 10)
-from jinja2 import Environment, FileSystemLoader
-import io, codecs, shelve, os
+from jinja2 import Environment, FileSystemLoader, nodes
+import io, codecs, shelve, os, glob
 import StringIO
 import inspect
+import hashlib
+import cPickle
+import json
+import time
+import uuid
+import zlib
+import numbers
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Event
+from Queue import Queue, Full
+import sqlite3
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 code_formatter = lambda x: ('<pre style="font: Courier New; line-height: 50%;">'+ \
                             (inspect.getsource(x).replace('\n','</pre><pre>')
                              if pd.notnull(x) else '') + '</pre>')
 
-def mpl2base64(fig, classes=''):
+def fig2png(fig):
+    """
+    The png bytes of a matplotlib figure, or fig if it already is png bytes
+    """
+    if isinstance(fig, str):
+        return fig
     io = StringIO.StringIO()
     fig.savefig(io, format='png')
-    stream = io.getvalue().encode('base64')
+    return io.getvalue()
+
+def fig2base64(fig):
+    return fig2png(fig).encode('base64')
+
+def mpl2base64(fig, classes=''):
+    stream = fig2base64(fig)
     strout = '<img class="%s" src="data:image/png;base64,%s"/>' % (classes, stream)
     return strout
 
 def get_duplicates(df, gb):
     return pd.concat(g for _, g in df.groupby(gb) if len(g) > 1)
 
+def frame2html(df, **kwargs):
+    return df.to_html(classes='pdtable', **kwargs)
+
+def frame_digest(df, **kwargs):
+    """
+    Digest of a dataframe's contents, and of the kwargs rendering it.
+    """
+    sha = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tostring())
+    sha.update(repr((list(df.columns), [str(x) for x in df.dtypes],
+                     sorted(kwargs.items()))))
+    return sha.hexdigest()
+
+def value_digest(val):
+    """
+    Digest of a picklable value, None if it cannot be pickled.
+    """
+    if isinstance(val, Lazy):
+        return val.digest
+    if isinstance(val, pd.DataFrame):
+        return frame_digest(val)
+    try:
+        return hashlib.sha1(cPickle.dumps(val, 2)).hexdigest()
+    except Exception:
+        return None
+
+class Lazy(object):
+    """
+    A Ninja context value rendered when first used, eg. the html of a
+    dataframe pushed with Ninja.push_pd. digest identifies the content.
+    """
+    def __init__(self, digest, render, *args, **kwargs):
+        self.digest = digest
+        self.render = render
+        self.args = args
+        self.kwargs = kwargs
+        self.rendered = None
+    def value(self):
+        if self.rendered is None:
+            self.rendered = self.render(*self.args, **self.kwargs)
+        return self.rendered
+    def __unicode__(self):
+        return unicode(self.value())
+    def __str__(self):
+        return str(self.value())
+    def __nonzero__(self):
+        return bool(self.value())
+    def __len__(self):
+        return len(self.value())
+    def __iter__(self):
+        return iter(self.value())
+    def __contains__(self, item):
+        return item in self.value()
+    def __getitem__(self, key):
+        return self.value()[key]
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.value(), name)
+
+class ArtifactStore():
+    """
+    Content-addressed store of Ninja values in a directory. objects/ holds
+    each distinct value once, named by the sha1 of its stored bytes:
+    dataframes as parquet (with pyarrow, read memory-mapped), figures as
+    png and anything else as zlib compressed pickles. Lazy values are
+    stored as their source dataframe or figure, and rendered on loading.
+    versions/ holds a json manifest of the keys' objects per saved
+    version; index.json maps value digests to objects, so a save writes
+    only the values not stored before.
+    """
+    RENDERERS = dict((f.__name__, f) for f in (frame2html, fig2base64, mpl2base64))
+    PARQUET_COMPRESSION = 'snappy'
+    PICKLE_COMPRESSION = 6  # zlib level
+
+    def __init__(self, path='ninja_store'):
+        self.path = path
+        for sub in ('objects', 'versions'):
+            if not os.path.isdir(os.path.join(path, sub)):
+                os.makedirs(os.path.join(path, sub))
+        self.index = self.read_json('index.json') or {}  # digest: object
+
+    def read_json(self, fn):
+        try:
+            with open(os.path.join(self.path, fn)) as fh:
+                return json.load(fh)
+        except IOError:
+            return None
+
+    def write_json(self, fn, obj):
+        fn = os.path.join(self.path, fn)
+        with open(fn + '.tmp', 'w') as fh:
+            json.dump(obj, fh, indent=1, sort_keys=True)
+        os.rename(fn + '.tmp', fn)
+
+    def object_path(self, oid):
+        return os.path.join(self.path, 'objects', oid[:2], oid[2:])
+
+    def write_object(self, data):
+        oid = hashlib.sha1(data).hexdigest()
+        fn = self.object_path(oid)
+        if not os.path.exists(fn):
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            with open(fn + '.tmp', 'wb') as fh:
+                fh.write(data)
+            os.rename(fn + '.tmp', fn)
+        return oid
+
+    def dump(self, val):
+        """
+        Writes a value's object(s).
+        :return: The value's entry in a manifest, a dict of its kind and
+                 object id; for lazy values, of its renderer and source
+        """
+        if isinstance(val, Lazy) and val.render.__name__ in self.RENDERERS \
+                and val.args:
+            try:
+                json.dumps(val.kwargs)
+            except (TypeError, ValueError):
+                pass
+            else:
+                source = val.args[0]
+                if val.render is frame2html:
+                    source = self.dump(source)
+                else:
+                    source = {'kind': 'png',
+                              'object': self.write_object(fig2png(source))}
+                return {'kind': 'lazy', 'render': val.render.__name__,
+                        'kwargs': val.kwargs, 'source': source}
+        if isinstance(val, Lazy):
+            val = val.value()
+        if isinstance(val, pd.DataFrame) and pa is not None:
+            try:
+                table = pa.Table.from_pandas(val)
+            except (pa.ArrowException, TypeError, ValueError):
+                pass  # eg. mixed types in a column, pickle it
+            else:
+                buf = pa.BufferOutputStream()
+                pq.write_table(table, buf, compression=self.PARQUET_COMPRESSION)
+                return {'kind': 'parquet',
+                        'object': self.write_object(buf.getvalue().to_pybytes())}
+        data = zlib.compress(cPickle.dumps(val, 2), self.PICKLE_COMPRESSION)
+        return {'kind': 'pickle', 'object': self.write_object(data)}
+
+    def load(self, entry):
+        """
+        Reads a value from its manifest entry, see dump.
+        """
+        if entry['kind'] == 'lazy':
+            return self.RENDERERS[entry['render']](self.load(entry['source']),
+                                                   **entry['kwargs'])
+        fn = self.object_path(entry['object'])
+        if entry['kind'] == 'parquet':
+            return pq.read_table(fn, memory_map=True).to_pandas()
+        with open(fn, 'rb') as fh:
+            data = fh.read()
+        if entry['kind'] == 'png':
+            return data
+        return cPickle.loads(zlib.decompress(data))
+
+    def save(self, jdata, version=None):
+        """
+        Saves a version of jdata, writing only the values whose digest
+        isn't in the index. Versions are never overwritten: a timestamp
+        already taken, by a save in the same second, gets a -<n> suffix,
+        and a given version name already taken raises ValueError.
+        :param version: Name of the version, by default a timestamp
+        :return: The name of the version
+        """
+        if version is not None:
+            if not self.claim_version(version):
+                raise ValueError('Version %s exists in %s'
+                                 % (version, self.path))
+        else:
+            stamp = version = time.strftime('%Y%m%d-%H%M%S')
+            suffix = 0
+            while not self.claim_version(version):
+                suffix += 1
+                version = '%s-%d' % (stamp, suffix)
+
+        manifest = {}
+        for key, val in jdata.items():
+            digest = value_digest(val)
+            entry = self.index.get(digest) if digest is not None else None
+            if entry is None:
+                entry = self.dump(val)
+                if digest is not None:
+                    self.index[digest] = entry
+            manifest[key] = dict(entry, digest=digest)
+        self.write_json('index.json', self.index)
+        self.write_json(os.path.join('versions', version + '.json'), manifest)
+        self.write_json('HEAD.json', version)
+        return version
+
+    def claim_version(self, version):
+        """
+        Creates a version's (empty) manifest file, unless it exists.
+        :return: Whether the version was claimed
+        """
+        fn = os.path.join(self.path, 'versions', version + '.json')
+        try:
+            os.close(os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            if os.path.exists(fn):
+                return False
+            raise
+        return True
+
+    def open(self, version=None):
+        """
+        The values of a version, by default the last saved, as Lazy values
+        read from the store when used.
+        """
+        version = version or self.read_json('HEAD.json')
+        if version is None:
+            raise KeyError('No versions saved in %s' % self.path)
+        try:
+            manifest = self.read_json(os.path.join('versions', version + '.json'))
+        except ValueError:  # claimed, not yet written
+            manifest = None
+        if manifest is None:
+            raise KeyError('No version %s in %s' % (version, self.path))
+        return dict((key, Lazy(entry['digest'] or entry['object'],
+                               self.load, entry))
+                    for key, entry in manifest.items())
+
+    def versions(self):
+        return sorted(fn[:-len('.json')] for fn in
+                      os.listdir(os.path.join(self.path, 'versions'))
+                      if fn.endswith('.json'))
+
 class Ninja():
-    def __init__(self, template_dir='templates', shelf='ninja.db'):
+    """
+    Context for html reports from jinja templates. Dataframes and figures
+    are pushed lazily, rendered only when a written template uses them;
+    don't modify them once pushed, or push with lazy=False.
+    write caches the output of each {% block %} by a digest of the values
+    it references, and renders only the blocks whose values changed.
+    With a store directory, shelve and unshelve save and open versions in
+    an ArtifactStore rather than the shelf.
+    """
+    def __init__(self, template_dir='templates', shelf='ninja.db', store=None):
         self.shelf = shelf
+        self.store = ArtifactStore(store) if store is not None else None
         self.jdata={}
         self.env = Environment(loader=FileSystemLoader(template_dir))
         self.template_dir = template_dir
+        self.block_names = {}  # template: (source digest, block: names)
+        self.fragments = {}  # template: {block digest: output}
     def update(self, dct):
         self.jdata.update(dct)
     def pull(self, key):
-        return self.jdata[key]
+        val = self.jdata[key]
+        return val.value() if isinstance(val, Lazy) else val
     def __getitem__(self, key):
-        return self.jdata[key]
+        return self.pull(key)
     def __setitem__(self, key, val):
         self.jdata[key] = val
     def push(self, key, obj):
         self.jdata[key] = obj
     def push_many(self, dct):
         self.jdata.update(dct)
-    def push_pd(self, key, df, **kwargs):
-        self.jdata[key] = df.to_html(classes='pdtable', **kwargs)
-    def push_figure(self, key, fig):
+    def push_pd(self, key, df, lazy=True, **kwargs):
+        html = Lazy(frame_digest(df, to_html=kwargs), frame2html, df, **kwargs)
+        self.jdata[key] = html if lazy else html.value()
+    def push_figure(self, key, fig, lazy=True):
         # Encode image to png in base64
-        io = StringIO();
-        fig.savefig(io, format='png');
-        stream = io.getvalue().encode('base64');
-        self.jdata[key] = stream
+        stream = Lazy(uuid.uuid4().hex, fig2base64, fig)
+        self.jdata[key] = stream if lazy else stream.value()
     def get_context(self):
         return self.jdata
-    def push_mpl(self, key, fig, classes=''):
-        self.jdata[key] = mpl2base64(fig, classes='')
+    def push_mpl(self, key, fig, classes='', lazy=True):
+        img = Lazy(uuid.uuid4().hex, mpl2base64, fig, classes=classes)
+        self.jdata[key] = img if lazy else img.value()
+    def get_block_names(self, tpl_filename):
+        """
+        The context names referenced in each block of a template, None
+        for blocks whose output can't be cached: scoped blocks, blocks
+        including or importing templates, calling super() or rendering
+        other blocks through self (whose names they'd depend on), and
+        blocks using variables or macros defined outside of blocks.
+        :return: (source digest, {block: names})
+        """
+        source = self.env.loader.get_source(self.env, tpl_filename)[0]
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        cached = self.block_names.get(tpl_filename)
+        if cached is not None and cached[0] == digest:
+            return cached
+        ast = self.env.parse(source)
+        outer = set(['super', 'self'])
+        stack = [ast]
+        while stack:
+            for node in stack.pop().iter_child_nodes():
+                if isinstance(node, nodes.Block):
+                    continue
+                if isinstance(node, nodes.Name) and node.ctx == 'store':
+                    outer.add(node.name)
+                elif isinstance(node, nodes.Macro):
+                    outer.add(node.name)
+                stack.append(node)
+        names = {}
+        for block in ast.find_all(nodes.Block):
+            refs = set(x.name for x in block.find_all(nodes.Name)
+                       if x.ctx == 'load')
+            if block.scoped or refs & outer or \
+                    any(True for _ in block.find_all(
+                        (nodes.Include, nodes.Import, nodes.FromImport))):
+                refs = None
+            names[block.name] = refs
+        self.block_names[tpl_filename] = (digest, names)
+        return self.block_names[tpl_filename]
     def write(self, tpl_filename='default.tpl', html_filename='report.html'):
         template = self.env.get_template(tpl_filename)
-        jout = template.render(self.jdata)
+        context = template.new_context(self.jdata)
+        source_digest, names = self.get_block_names(tpl_filename)
+        cached = self.fragments.get(tpl_filename, {})
+        fragments = {}
+
+        def cache(render, digest):
+            def render_cached(context):
+                if digest not in cached:
+                    cached[digest] = u''.join(render(context))
+                fragments[digest] = cached[digest]
+                yield cached[digest]
+            return render_cached
+
+        digests = {}
+        for block, refs in names.items():
+            if refs is None or block not in context.blocks:
+                continue
+            for key in refs - set(digests):
+                digests[key] = value_digest(self.jdata[key]) \
+                    if key in self.jdata else 'missing'
+            if any(digests[key] is None for key in refs):
+                continue
+            digest = hashlib.sha1(repr((source_digest, block, sorted(
+                (key, digests[key]) for key in refs)))).hexdigest()
+            context.blocks[block][0] = cache(context.blocks[block][0], digest)
+
+        jout = u''.join(template.root_render_func(context))
+        self.fragments[tpl_filename] = fragments
         with codecs.open(html_filename, "wb", encoding='utf-8') as fh:
             fh.write(jout)
-    def shelve(self, shelf=None, **kwargs):
+    def shelve(self, shelf=None, version=None, **kwargs):
+        if self.store is not None:
+            return self.store.save(self.jdata, version)
         if shelf is None:
             shelf = self.shelf
         sh = shelve.open(shelf, flag='n', **kwargs)
-        sh.update(self.jdata)
+        sh.update((key, self.pull(key)) for key in self.jdata)
         sh.close()
-    def unshelve(self, shelf=None, **kwargs):
+    def unshelve(self, shelf=None, version=None, **kwargs):
+        if self.store is not None:
+            self.jdata.update(self.store.open(version))
+            return
         if shelf is None:
             shelf = self.shelf
         sh = shelve.open(shelf, flag='r', **kwargs)
@@ -84,68 +426,337 @@ class Ninja():
     def unpack(self):
         locals().update(self.jdata)
 
+class ChunkWriter():
+    """
+    Appends dataframe chunks to one output file, kept open between
+    chunks. Formats: 'csv', 'jsonl' (a json record per line) and
+    'parquet' (a row group per chunk, requires pyarrow); by default the
+    format is fnout's extension, or csv.
+    """
+    FORMATS = ('csv', 'jsonl', 'parquet')
+
+    def __init__(self, fnout, drop=True, fmt=None, encoding='utf-8'):
+        self.fnout = fnout
+        if fmt is None:
+            fmt = os.path.splitext(fnout)[1].lstrip('.').lower()
+            fmt = fmt if fmt in self.FORMATS else 'csv'
+        self.fmt = fmt
+        if self.fmt not in self.FORMATS:
+            raise ValueError('Unsupported output format: %s' % self.fmt)
+        if self.fmt == 'parquet':
+            if pa is None:
+                raise ImportError('parquet output requires pyarrow')
+            if not drop:
+                raise ValueError('parquet output cannot be appended to')
+        self.encoding = encoding
+        self.writer = None  # pyarrow ParquetWriter
+        self.fout = None
+        self.write_header = drop
+        self.count = 0
+        if self.fmt != 'parquet':
+            self.fout = open(fnout, 'w' if drop else 'a')
+            self.write_header = drop or self.fout.tell() == 0
+
+    def write(self, df):
+        if self.fmt == 'csv':
+            df.to_csv(self.fout, index=False, header=self.write_header,
+                      encoding=self.encoding)
+        elif self.fmt == 'jsonl':
+            if len(df):
+                self.fout.write(df.to_json(orient='records', lines=True))
+                self.fout.write('\n')
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.fnout, table.schema)
+            self.writer.write_table(table)
+        self.write_header = False
+        self.count += len(df)
+
+    def close(self):
+        if self.fout is not None:
+            self.fout.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def merge_stats(stats, chunk_stats):
+    """
+    Default reduce_stats for transform_csv: sums numeric counters and
+    keeps the latest value of anything else.
+    """
+    for key, val in chunk_stats.items():
+        if isinstance(val, numbers.Number) and \
+                isinstance(stats.get(key), numbers.Number):
+            stats[key] += val
+        else:
+            stats[key] = val
+    return stats
+
+def _transform_chunk(transform, chunk, transform_kwargs):
+    # Runs in a transform_csv worker process, with the chunk's own stats
+    stats = {}
+    return transform(chunk, stats, **transform_kwargs), stats
+
 def transform_csv(fnin, transform, fnout='file.csv', drop=True, chunksize=50000,
-                  transform_kwargs=None, nrows=None, sep=','):
-    chunk_sum = 0
-    if drop:
-        try:
-            os.remove(fnout)
-        except OSError:
-            pass
+                  transform_kwargs=None, nrows=None, sep=',', dtype=str,
+                  processes=None, reduce_stats=merge_stats, window=None,
+                  fmt=None):
+    """
+    Transforms a csv chunk by chunk into fnout, stopping after nrows rows.
+    fnout is written in format fmt, see ChunkWriter.
+    With processes > 1, chunks are transformed in a pool of worker
+    processes while the next chunks are read, up to window chunks
+    (default 2 per process) at a time, and written in input order. Each
+    chunk's transform then gets its own stats, which are combined with
+    reduce_stats(stats, chunk_stats); transform must be picklable, ie.
+    a module level function.
+    :return: stats
+    """
+    transform_kwargs = transform_kwargs or {}
     stats = {}  # dict to store counters through chunks
-    write_header = True
-    for chunk in pd.read_csv(fnin,
-                             chunksize=chunksize,
-                             sep=sep,
-                             index_col=False,
-                             dtype=str):
-        if nrows is not None and chunk_sum > nrows:
-            continue
-        df = transform(chunk, stats, **transform_kwargs)
-        df.to_csv(fnout, mode='a', index=False, header=write_header)
-        write_header=False
-        chunk_sum += chunksize
-        print '++ %d = %d' % (chunksize, chunk_sum)
+    pool = None
+    if processes > 1:
+        pool = Pool(processes)
+        window = window or 2 * processes
+    pending = deque()
+    chunk_sum = [0]
+
+    with ChunkWriter(fnout, drop, fmt) as writer:
+
+        def write(df, count):
+            writer.write(df)
+            chunk_sum[0] += count
+            print '++ %d = %d' % (count, chunk_sum[0])
+
+        def collect():
+            count, result = pending.popleft()
+            df, chunk_stats = result.get()
+            reduce_stats(stats, chunk_stats)
+            write(df, count)
+
+        try:
+            for chunk in pd.read_csv(fnin,
+                                     chunksize=chunksize,
+                                     nrows=nrows,
+                                     sep=sep,
+                                     index_col=False,
+                                     dtype=dtype):
+                if pool is None:
+                    write(transform(chunk, stats, **transform_kwargs),
+                          len(chunk))
+                    continue
+                pending.append((len(chunk), pool.apply_async(
+                    _transform_chunk, (transform, chunk, transform_kwargs))))
+                if len(pending) >= window:
+                    collect()
+            while pending:
+                collect()
+        finally:
+            if pool is not None:
+                pool.terminate()
     return stats
 
 import pandas.io.sql as psql
 import pyodbc as odbc
 
-def transform_mssql(con, q, transform=None, fnout='cached.csv', drop=True, chunksize=50000,
-                  transform_kwargs=None, nrows=None):
-    if drop:
+PREFETCH_POLL = 0.1  # seconds between a blocked reader's checks for a stop
+
+def prefetch(pages, depth=1):
+    """
+    Iterates over pages, reading up to depth pages ahead on a background
+    thread. Exceptions in the reader are raised in the caller. Once the
+    caller stops, by exhausting or closing the iterator, the reader stops
+    too and closes pages (eg. a cursor_pages cursor) on its own thread.
+    """
+    queue = Queue(depth)
+    done = object()
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=PREFETCH_POLL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def read():
         try:
-            os.remove(fnout)
-        except OSError:
-            pass
-    stats = {}  # dict to store counters through chunks
-    write_header = True
-    
-    chunk_start = 1
-    chunk_sum = 0
+            try:
+                for page in pages:
+                    if not put((page, None)):
+                        return
+            except Exception, e:
+                put((None, e))
+                return
+            put((done, None))
+        finally:
+            if hasattr(pages, 'close'):
+                pages.close()
 
-    while chunk_sum % chunksize == 0 and (nrows is None or chunk_start < nrows):
+    reader = Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            page, e = queue.get()
+            if e is not None:
+                raise e
+            if page is done:
+                break
+            yield page
+    finally:
+        stop.set()
+        reader.join()
+
+def row_number_pages(con, q, chunksize, nrows=None):
+    """
+    Pages of q formatted with the {row_i} and {row_f} row numbers of
+    each page, eg. a ROW_NUMBER() window, re-evaluated for every page.
+    """
+    chunk_start = 1
+    while nrows is None or chunk_start <= nrows:
         query = q.format(**{'row_i': chunk_start,
                             'row_f': chunk_start + chunksize-1})
         print query
         chunk = psql.read_sql_query(query, con)
         if chunk.empty:
             break
-        if transform is not None:
-            chunk = transform(chunk, stats, **transform_kwargs)
-        chunk.to_csv(fnout, mode='a', index=False, header=write_header, encoding="utf-8")
-        write_header=False
+        yield chunk
+        if len(chunk) < chunksize:
+            break
         chunk_start += len(chunk)
+
+def keyset_filter(key):
+    """
+    The {key_filter} of a keyset page after the last key, a row value
+    comparison spelled out for dialects without one, eg. for key (A, B):
+    (A > ?) OR (A = ? AND B > ?)
+    """
+    terms = []
+    for idx, field in enumerate(key):
+        terms.append('(%s)' % ' AND '.join(['%s = ?' % x for x in key[:idx]] +
+                                           ['%s > ?' % field]))
+    return '(%s)' % ' OR '.join(terms)
+
+def keyset_pages(con, q, key, chunksize, nrows=None):
+    """
+    Pages of q formatted with the {chunksize} and {key_filter} of each
+    page, eg. SELECT TOP {chunksize} * FROM T WHERE {key_filter} ORDER BY K
+    in SQL Server or ... ORDER BY K LIMIT {chunksize} in SQLite. Pages
+    after the first seek past the last key with parameters, so an index
+    on the key serves every page without sorting the rows before it.
+    """
+    last = None
+    chunk_sum = 0
+    while nrows is None or chunk_sum < nrows:
+        size = chunksize if nrows is None else min(chunksize, nrows - chunk_sum)
+        query = q.format(chunksize=size,
+                         key_filter='1 = 1' if last is None else keyset_filter(key))
+        params = None
+        if last is not None:
+            params = [v for idx in range(len(key)) for v in last[:idx + 1]]
+        chunk = psql.read_sql_query(query, con, params=params)
+        if chunk.empty:
+            break
+        yield chunk
         chunk_sum += len(chunk)
-        print '++ %d = %d records' % (len(chunk), chunk_sum)
-        
+        if len(chunk) < size:
+            break
+        last = [chunk[x].iloc[-1] for x in key]
+        # numpy scalars to python values the drivers can bind
+        last = [x.item() if isinstance(x, pd.np.generic) else x for x in last]
+
+def cursor_pages(con, q, chunksize, nrows=None):
+    """
+    Pages fetched with fetchmany from a single execution of q.
+    """
+    cursor = con.cursor()
+    try:
+        cursor.execute(q)
+        columns = [x[0] for x in cursor.description]
+        chunk_sum = 0
+        while nrows is None or chunk_sum < nrows:
+            size = chunksize if nrows is None else min(chunksize, nrows - chunk_sum)
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records([tuple(x) for x in rows],
+                                            columns=columns)
+            chunk_sum += len(rows)
+    finally:
+        cursor.close()
+
+def transform_mssql(con, q, transform=None, fnout='cached.csv', drop=True, chunksize=50000,
+                  transform_kwargs=None, nrows=None, key=None, paging=None,
+                  prefetch_pages=None, fmt=None):
+    """
+    Transforms the result of query q page by page into fnout.
+    paging is one of:
+    'row_number' (the default when q has a {row_i} field) - q is formatted
+        with each page's row numbers, see row_number_pages
+    'keyset' (the default when a key is given) - q is formatted with each
+        page's size and key filter, see keyset_pages
+    'cursor' - q is executed once and its rows fetched in pages
+    Up to prefetch_pages pages are read ahead on a background thread while
+    a page is transformed and written, so con must be usable from other
+    threads; 0 reads in turn. By default one page is read ahead, except
+    on sqlite3 connections, which are bound to their thread unless made
+    with check_same_thread=False. fnout is written in format fmt, see
+    ChunkWriter.
+    :param key: Key field or list of key fields, ordering the query
+    :return: stats
+    """
+    transform_kwargs = transform_kwargs or {}
+    if isinstance(key, basestring):
+        key = [key]
+    if paging is None:
+        paging = 'keyset' if key else \
+            'row_number' if '{row_i}' in q else 'cursor'
+    if paging == 'row_number':
+        pages = row_number_pages(con, q, chunksize, nrows)
+    elif paging == 'keyset':
+        if not key:
+            raise ValueError('keyset paging requires a key')
+        pages = keyset_pages(con, q, key, chunksize, nrows)
+    elif paging == 'cursor':
+        pages = cursor_pages(con, q, chunksize, nrows)
+    else:
+        raise ValueError('Unknown paging: %s' % paging)
+    if prefetch_pages is None:
+        prefetch_pages = 0 if isinstance(con, sqlite3.Connection) else 1
+    if prefetch_pages:
+        pages = prefetch(pages, prefetch_pages)
+
+    stats = {}  # dict to store counters through chunks
+    chunk_sum = 0
+    try:
+        with ChunkWriter(fnout, drop, fmt) as writer:
+            for chunk in pages:
+                count = len(chunk)
+                if transform is not None:
+                    chunk = transform(chunk, stats, **transform_kwargs)
+                writer.write(chunk)
+                chunk_sum += count
+                print '++ %d = %d records' % (count, chunk_sum)
+    finally:
+        # stop reading, and close the cursor, if stopped early
+        pages.close()
+
     return stats
 
 def df_memory(df):
     """
-    The approximate memory footprint of a dataframe in MB
+    The memory footprint of a dataframe in MB, including the strings
     """
-    return (df.values.nbytes + df.index.nbytes + df.columns.nbytes) * 1e-6
+    return df.memory_usage(index=True, deep=True).sum() * 1e-6
 
 
 def pull_source_code(fi, check_module):
@@ -158,18 +769,99 @@ def pull_source_code(fi, check_module):
         return pd.Series([inspect.getsource(fun), fun],
                          ['vfn','src'])
 
-def load_csvs(files, transformation=None):
-    result = '<table><tr><th>Data Key</th><th>Filename</th><th>Frame Dimensions</th><th>In-memory usage</th></tr>'
+CSV_HASH_BYTES = 1 << 20  # bytes hashed at each end of a csv for its sidecar
+
+def csv_cache_key(f, dtype=str):
+    """
+    Digest of a csv file's size, mtime, first and last CSV_HASH_BYTES
+    bytes, and of the dtype parsing it.
+    """
+    st = os.stat(f)
+    if isinstance(dtype, dict):
+        dtype = sorted(dtype.items())
+    sha = hashlib.sha1(repr((st.st_size, st.st_mtime, dtype)))
+    with open(f, 'rb') as fh:
+        sha.update(fh.read(CSV_HASH_BYTES))
+        if st.st_size > 2 * CSV_HASH_BYTES:
+            fh.seek(-CSV_HASH_BYTES, os.SEEK_END)
+            sha.update(fh.read())
+    return sha.hexdigest()
+
+def load_csv(f, dtype=str, cache_dir=None):
+    """
+    Reads a csv file, or the sidecar of its dataframe in cache_dir if the
+    file hasn't changed since it was written (see csv_cache_key). Sidecars
+    are parquet, read memory-mapped, or pickles without pyarrow.
+    :return: (dataframe, seconds loading, whether the sidecar was read)
+    """
+    t0 = time.time()
+    if cache_dir is None:
+        return pd.read_csv(f, dtype=dtype), time.time() - t0, False
+    stem = os.path.join(cache_dir, '%s-%s' % (
+        os.path.basename(f),
+        hashlib.sha1(os.path.abspath(f)).hexdigest()[:10]))
+    sidecar = '%s-%s.%s' % (stem, csv_cache_key(f, dtype)[:16],
+                            'parquet' if pa is not None else 'pkl')
+    if os.path.exists(sidecar):
+        if pa is not None:
+            df = pq.read_table(sidecar, memory_map=True).to_pandas()
+        else:
+            df = pd.read_pickle(sidecar)
+        return df, time.time() - t0, True
+
+    df = pd.read_csv(f, dtype=dtype)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:  # made by another thread
+            pass
+    for stale in glob.glob(stem + '-*'):
+        if not stale.endswith('.tmp'):
+            os.remove(stale)
+    tmp = '%s.%s.tmp' % (sidecar, uuid.uuid4().hex)
+    if pa is not None:
+        pq.write_table(pa.Table.from_pandas(df), tmp)
+    else:
+        df.to_pickle(tmp, compression=None)
+    os.rename(tmp, sidecar)
+    return df, time.time() - t0, False
+
+def load_csvs(files, transformation=None, dtype=str, processes=None,
+              cache_dir=None):
+    """
+    Loads csv files into dataframes, reporting their sizes, load times
+    and cache hits as html.
+    dtype is passed to read_csv; None infers numeric columns, and a dict
+    can make repetitive columns 'category', both far smaller than
+    strings.
+    With processes > 1 the files are read in a pool of that many threads.
+    With a cache_dir, each parsed dataframe is kept in a sidecar file
+    there and read instead of the csv while the csv is unchanged, see
+    load_csv; transformation is applied after loading either way.
+    """
+    result = '<table><tr><th>Data Key</th><th>Filename</th><th>Frame Dimensions</th><th>In-memory usage</th><th>Load time</th><th>Cache</th></tr>'
+    items = list(files.items())
+    load = lambda item: load_csv(item[1], dtype, cache_dir)
+    if processes > 1:
+        pool = ThreadPool(processes)
+        try:
+            loaded = pool.map(load, items)
+        finally:
+            pool.close()
+    else:
+        loaded = [load(item) for item in items]
     dct={}
-    for key, f in files.items():
-        df = pd.read_csv(f, dtype=str)
+    for (key, f), (df, elapsed, hit) in zip(items, loaded):
         if transformation is not None:
             df = transformation(df)
-        result += """<tr><td>{key}</td><td>{f}</td><td>{dfdim}</td><td>{mem}</td></tr>
+        result += """<tr><td>{key}</td><td>{f}</td><td>{dfdim}</td><td>{mem}</td><td>{elapsed}</td><td>{cache}</td></tr>
                   """.format(**dict(key=key,
                                     f=f,
                                     dfdim='%d rows x %d columns' % (len(df), len(df.columns)),
-                                    mem='%.2f MB' % df_memory(df)))
+                                    mem='%.2f MB' % df_memory(df),
+                                    elapsed='%.2f s' % elapsed,
+                                    cache='hit' if hit else
+                                          'miss' if cache_dir is not None else ''))
         dct[key] = df
         del df
     result += '</table>'
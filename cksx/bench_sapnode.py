@@ -0,0 +1,143 @@
+#!/usr/bin/env python2.7
+"""
+Microbenchmark for sapnode.assemble, the parsing of a fetched row-wise
+chunk into a dataframe, against the previous row-wise assembly that
+concatenated each row's lists once per column-wise chunk. assemble is
+timed on both delimited and fixed-width rows.
+
+Synthetic BBP_RFC_READ_TABLE 'DATA' payloads are generated for the given
+shape. Each variant runs in its own process; allocation is reported as
+the growth in peak resident memory during assembly.
+
+With 'fetch', fetch_chunk is timed instead, serially and with the
+vchunks fetched concurrently (fetch_parallel), against a stand-in for
+the RFC connection that answers after a delay. The two must assemble
+to the same rows, in order.
+
+Usage: python bench_sapnode.py [nrows=100000] [ncols=400] [field_width=9]
+       python bench_sapnode.py fetch [nvchunks=6] [delay=0.2] [nrows=1000]
+"""
+import sys
+import resource
+from multiprocessing import Process, Queue
+from time import sleep, time
+import pandas as pd
+import sapnode
+from sapnode import assemble, fetch_chunk
+
+
+def synthetic_fetch(nrows, ncols, width, sap_buffer_size=400, delimiter='|'):
+    """
+    Builds a fetched chunk, as returned by sapnode.fetch, with every field
+    holding a distinct value of the given width.
+    :return: List of (vchunk, DATA, layout) triples
+    """
+    fields = ['F%03d' % idx for idx in range(ncols)]
+    step = width + len(delimiter)
+    per_vchunk = max(1, sap_buffer_size // step)
+    fetched = []
+    for c0 in range(0, ncols, per_vchunk):
+        vchunk = fields[c0:c0 + per_vchunk]
+        rows = [{'WA': delimiter.join(u'%*d' % (width, ri * ncols + c0 + idx)
+                                      for idx in range(len(vchunk)))}
+                for ri in range(nrows)]
+        layout = None
+        if not delimiter:
+            layout = [(idx * step, width) for idx in range(len(vchunk))]
+        fetched.append((vchunk, rows, layout))
+    return fetched
+
+
+def legacy_assemble(fetched):
+    """
+    The row-wise assembly that assemble replaces.
+    """
+    data = None
+    fields = None
+    for vchunk, rows, _ in fetched:
+        chunk = [map(unicode.strip, x['WA'].split('|')) for x in rows]
+        if data is None:
+            data = chunk
+            fields = list(vchunk)
+        else:
+            data = [data[idx] + chunkrow
+                    for idx, chunkrow in enumerate(chunk)]
+            fields += vchunk
+    return pd.DataFrame(data=data, columns=fields)
+
+
+def assemble_fixed_width(fetched):
+    return assemble(fetched)
+
+
+def run(func, shape, results):
+    delimiter = '' if func is assemble_fixed_width else '|'
+    fetched = synthetic_fetch(*shape, delimiter=delimiter)
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time()
+    df = func(fetched)
+    elapsed = time() - t0
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((func.__name__, elapsed, (rss1 - rss0) / 1024., df.shape))
+
+
+class DelayedConnection(object):
+    """
+    Stands in for pyrfc.Connection: BBP_RFC_READ_TABLE answers after
+    delay seconds with rows whose fields hold '<field>.<row>'.
+    """
+    delay = 0.2
+
+    def __init__(self, **cnxn_details):
+        pass
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+    def call(self, func, FIELDS=(), ROWCOUNT=0, ROWSKIPS=0, DELIMITER='|',
+             **kwargs):
+        sleep(self.delay)
+        rows = range(ROWSKIPS, ROWSKIPS + ROWCOUNT)
+        return {'DATA': [{'WA': DELIMITER.join(u'%s.%d' % (f['FIELDNAME'], ri)
+                                               for f in FIELDS)}
+                         for ri in rows] or None,
+                'FIELDS': []}
+
+
+def bench_fetch(nvchunks, delay, nrows):
+    sapnode.SAP_cnxn = DelayedConnection
+    DelayedConnection.delay = delay
+    vchunks = [['F%02d' % idx] for idx in range(nvchunks)]
+    results = []
+    for workers in (1, nvchunks):
+        t0 = time()
+        df = assemble(fetch_chunk({}, 'T', vchunks, 0, nrows, '',
+                                  vchunk_workers=workers))
+        results.append(df)
+        print('vchunk_workers=%-3d %8.2f s' % (workers, time() - t0))
+    expected = [[u'F%02d.%d' % (idx, ri) for idx in range(nvchunks)]
+                for ri in range(nrows)]
+    assert all(df.values.tolist() == expected for df in results), \
+        'vchunks did not join by position'
+    print('rows joined in vchunk order')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['fetch']:
+        args = [f(x) for f, x in zip((int, float, int), sys.argv[2:5])]
+        bench_fetch(*(args + [6, 0.2, 1000][len(args):]))
+        sys.exit()
+    shape = tuple(int(x) for x in sys.argv[1:4])
+    shape = shape + (100000, 400, 9)[len(shape):]
+    print('%d rows x %d columns, field width %d' % shape)
+    results = Queue()
+    for func in (legacy_assemble, assemble, assemble_fixed_width):
+        p = Process(target=run, args=(func, shape, results))
+        p.start()
+        name, elapsed, peak_mb, df_shape = results.get()
+        p.join()
+        print('%-22s %8.2f s %10.1f MB peak growth  %s'
+              % (name, elapsed, peak_mb, df_shape))
@@ -1,18 +1,436 @@
 #!/usr/bin/env python3
 from queue import Queue
-from threading import Thread
-from time import sleep
+from threading import Thread, Lock, Condition
+from time import sleep, time
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 import requests
 import json
+import hashlib
+import os
+import re
+import uuid
 import sys
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import numpy as np
 import pandas as pd
 from io import StringIO
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+MIMETYPES = {'json': 'application/json',
+             'arrow': 'application/vnd.apache.arrow.stream',
+             'parquet': 'application/vnd.apache.parquet'}
+
+# dtypes for DD03L INTTYPEs, see infer_dtypes
+SAP_DTYPES = {'b': 'UInt8',   # INT1
+              's': 'Int16',   # INT2
+              'I': 'Int32',   # INT4
+              '8': 'Int64',   # INT8
+              'P': 'float64',  # packed decimal, e.g. CURR, QUAN, DEC
+              'F': 'float64',
+              'D': 'datetime64[s]'}  # DATS, YYYYMMDD, up to 99991231
+PACKED_FLOAT_DIGITS = 15  # wider packed fields are Decimals, not float64
+CATEGORY_MAX_LENG = 5  # CHAR fields this short are codes: categories
+CATEGORY_MAX_SHARE = 0.5  # unless their distinct values exceed this share
+
+
+class TableError(ValueError):
+    """
+    An error in a table's definition, e.g. an unknown table or fields, or
+    no key fields to partition by, rather than on the node that found it.
+    """
+
+
+def infer_dtypes(meta):
+    """
+    Maps a table's fields to compact dtypes from their DD03L metadata:
+    integers and packed numbers to numeric dtypes, dates to datetime64
+    at second resolution, which holds SAP's 99991231, and short CHAR
+    fields (LENG up to CATEGORY_MAX_LENG), mostly codes such as BUKRS or
+    WAERS, to category, where their values repeat (see cast_sap).
+    Packed numbers of more than PACKED_FLOAT_DIGITS digits, which float64
+    can't hold exactly, are 'decimal': Decimal objects. Other fields,
+    including NUMC, whose leading zeros matter, stay strings.
+    :param meta: Metadata dataframe, see SAPTable.get_meta
+    :return: Dictionary of field: dtype
+    """
+    dtypes = {}
+    for field, inttype, leng in zip(meta.FIELDNAME, meta.INTTYPE, meta.LENG):
+        if inttype == 'P' and leng > PACKED_FLOAT_DIGITS:
+            dtypes[field] = 'decimal'
+        elif inttype in SAP_DTYPES:
+            dtypes[field] = SAP_DTYPES[inttype]
+        elif inttype == 'C' and leng <= CATEGORY_MAX_LENG:
+            dtypes[field] = 'category'
+    return dtypes
+
+
+def cast_sap(series, dtype):
+    """
+    Casts a string column as read from SAP to dtype, parsing SAP's
+    trailing minus signs ('12.50-') and empty dates ('00000000').
+    Columns are only made categories if at most CATEGORY_MAX_SHARE of
+    their values are distinct. Dates need pandas 2 for their second
+    resolution, and stay strings with older pandas.
+    :param series: Column of strings
+    :param dtype: Target dtype, see infer_dtypes
+    :return: Cast column
+    """
+    if dtype == 'category':
+        if series.nunique() > CATEGORY_MAX_SHARE * len(series):
+            return series
+        return series.astype('category')
+    s = series.str.strip()
+    if dtype.startswith('datetime'):
+        if int(pd.__version__.split('.')[0]) < 2:
+            return series
+        return map_unique(s, parse_dats, dtype)
+    negative = s.str.endswith('-').fillna(False).astype(bool)
+    s = s.where(~negative, '-' + s.str[:-1])
+    if dtype == 'decimal':
+        return map_unique(s, parse_decimal, object)
+    return pd.to_numeric(s, errors='coerce').astype(dtype)
+
+
+def map_unique(series, parse, dtype):
+    """
+    Parses a column's distinct values once each.
+    :param parse: Function of a value, returning the parsed value
+    :param dtype: dtype of the parsed column
+    """
+    codes, uniques = pd.factorize(series)
+    parsed = np.array([parse(x) for x in uniques] + [parse(None)],
+                      dtype=dtype)
+    return pd.Series(parsed[codes], index=series.index)  # -1 for nulls
+
+
+def parse_dats(value):
+    """
+    Parses a DATS value, YYYYMMDD, or NaT if empty ('00000000') or invalid.
+    """
+    try:
+        return np.datetime64(datetime.strptime(value, '%Y%m%d'), 's')
+    except (TypeError, ValueError):
+        return np.datetime64('NaT', 's')
+
+
+def parse_decimal(value):
+    """
+    Parses a packed number exactly, or None if empty or invalid.
+    """
+    try:
+        return Decimal(value)
+    except (TypeError, InvalidOperation):
+        return None
+
+
+def decode_frame(content, content_type):
+    """
+    Decodes a binary (arrow or parquet) response from the SAP node.
+    :param content: Response body, bytes
+    :param content_type: Response Content-Type header
+    :return: (dataframe, message); the message is the json status the
+             node attached to the schema metadata
+    """
+    if content_type.startswith(MIMETYPES['arrow']):
+        table = pa.ipc.open_stream(content).read_all()
+    else:
+        table = pq.read_table(pa.BufferReader(content))
+    msg = json.loads(table.schema.metadata[b'chalk'])
+    return table.to_pandas(split_blocks=True, self_destruct=True), msg
+
+
+def decode_message(content_type, content, dtypes=None, keep=True):
+    """
+    Decodes a /read response, or a line of a streamed one.
+    :param content_type: Response Content-Type header
+    :param content: Response body, bytes
+    :param dtypes: dtypes for read_csv
+    :param keep: Decode the data, into 'DATA'
+    :return: The status message, with the dataframe in 'DATA' if kept
+    """
+    if content_type.startswith(MIMETYPES['json']) or \
+            content_type.startswith('text/'):
+        msg = json.loads(content)
+        if keep and 'DATA' in msg:
+            msg['DATA'] = pd.read_csv(StringIO(msg['DATA']), dtype=dtypes)
+    else:
+        df, msg = decode_frame(content, content_type)
+        if keep:
+            msg['DATA'] = df
+    return msg
+
+
+decode_pool = None
+decode_pool_lock = Lock()
+
+
+def get_decode_pool(workers):
+    """
+    Returns the process pool decoding responses (see SAPTable
+    decode_workers), starting it on first use. Its processes are spawned,
+    not forked, as the extractor is multithreaded by then.
+    """
+    global decode_pool
+    with decode_pool_lock:
+        if decode_pool is None:
+            decode_pool = ProcessPoolExecutor(workers,
+                                              mp_context=get_context('spawn'))
+        return decode_pool
+
+
+def decode_shared(content_type, content, dtypes=None):
+    """
+    decode_message for a decoding process. The dataframe is handed back
+    as an Arrow IPC stream in a shared memory block rather than pickled.
+    :return: (status message, shared memory name, stream size); the name
+             is None if there is no data
+    """
+    msg = decode_message(content_type, content, dtypes)
+    df = msg.pop('DATA', None)
+    if df is None:
+        return msg, None, 0
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    def write(sink):
+        writer = pa.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+
+    # Size the stream, then write it straight into the block
+    mock = pa.MockOutputStream()
+    write(mock)
+    size = mock.size()
+    shm = SharedMemory(create=True, size=max(1, size))
+    try:
+        write(pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf)))
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return msg, shm.name, size
+
+
+def attach_shared(msg, name, size):
+    """
+    Reads the dataframe decode_shared left in shared memory into 'DATA'
+    of its message, and frees the block.
+    """
+    if name is None:
+        return msg
+    shm = SharedMemory(name=name)
+    try:
+        # One copy out of the block, as the dataframe may reference its
+        # buffers and the block is closed here
+        table = pa.ipc.open_stream(bytes(shm.buf[:size])).read_all()
+        msg['DATA'] = table.to_pandas(split_blocks=True, self_destruct=True)
+    finally:
+        shm.close()
+        shm.unlink()
+    return msg
+
+
+def key_bound(key_fields, values, op):
+    """
+    Builds an Open SQL condition comparing a composite key with values in
+    lexicographic order, e.g. for op '>=' and keys (K1, K2):
+    ( K1 > 'a' OR ( K1 = 'a' AND K2 >= 'b' ) )
+    :param key_fields: The key fields, in key order
+    :param values: The key values to compare with
+    :param op: '>=' for a lower bound, '<' for an upper bound
+    :return: Condition string
+    """
+    field = key_fields[0]
+    value = "'%s'" % str(values[0]).replace("'", "''")
+    if len(key_fields) == 1:
+        return '%s %s %s' % (field, op, value)
+    strict = '>' if op == '>=' else '<'
+    return '( %s %s %s OR ( %s = %s AND %s ) )' % (
+        field, strict, value, field, value,
+        key_bound(key_fields[1:], values[1:], op))
+
+
+class WatermarkStore:
+    """
+    High-water marks of incremental extractions (see SAPTable delta_field),
+    persisted in a json file and keyed by source system, table and target.
+    """
+    def __init__(self, path='watermarks.json'):
+        self.path = path
+        self.lock = Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, key):
+        """
+        :param key: Watermark key, see SAPTable.table_key
+        :return: The stored mark, or None before the first complete run
+        """
+        with self.lock:
+            return self.load().get(key)
+
+    def set(self, key, mark):
+        """
+        Stores a mark, replacing the file so a crash can't leave it
+        half-written.
+        """
+        with self.lock:
+            marks = self.load()
+            marks[key] = mark
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(marks, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+class MetaCache:
+    """
+    Table metadata and vchunk plans from the nodes' /meta, kept in memory
+    and as json files in a directory, for ttl seconds. Keyed by system
+    and table, and by what the vchunks were planned for.
+    """
+    def __init__(self, path='meta_cache', ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}  # file name: entry
+        self.lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest() + \
+            '.json'
+
+    def get(self, key):
+        """
+        :param key: Cache key, json-serialisable, see SAPTable.meta_key
+        :return: (metadata dataframe, vchunks), or None if missing or
+                 older than ttl
+        """
+        name = self.filename(key)
+        with self.lock:
+            entry = self.entries.get(name)
+            path = os.path.join(self.path, name)
+            if entry is None and os.path.exists(path):
+                with open(path) as f:
+                    entry = json.load(f)
+                self.entries[name] = entry
+        if entry is None or time() - entry['time'] > self.ttl:
+            return None
+        return pd.read_csv(StringIO(entry['meta_csv'])), entry['vchunks']
+
+    def set(self, key, meta, vchunks):
+        entry = {'time': time(), 'key': key,
+                 'meta_csv': meta.to_csv(index=False), 'vchunks': vchunks}
+        name = self.filename(key)
+        path = os.path.join(self.path, name)
+        with self.lock:
+            self.entries[name] = entry
+            with open(path + '.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.replace(path + '.tmp', path)
+
+
+class SpillWriter:
+    """
+    Collects a streamed task's batches straight into part files in
+    spill_dir, in place of the list of frames (see
+    SAPTableTask.read_stream), so the client holds about one batch of a
+    kept chunk rather than all of it. Batches are appended to an Arrow IPC
+    (Feather) file while their schema matches; a batch whose types differ,
+    e.g. in a column empty until then, starts the next part file.
+    Categories are written as their values, as an IPC file holds one
+    dictionary per field (see SAPTable.restore_categories). With
+    decode_workers, batches are written as their decoding completes, in
+    order.
+    """
+    def __init__(self, task):
+        self.task = task
+        self.paths = []
+        self.writer = None
+        self.schema = None  # of the part file being written
+        self.pending = []  # decoding futures, in order
+
+    def append(self, frame):
+        """
+        :param frame: A batch's dataframe, or its decoding future
+        """
+        if not isinstance(frame, Future):
+            self.write(frame)
+            return
+        self.pending.append(frame)
+        while self.pending and self.pending[0].done():
+            self.write(self.task.table.collect_decode(
+                self.pending.pop(0))['DATA'])
+
+    def write(self, df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        for idx, field in enumerate(table.schema):
+            if pa.types.is_dictionary(field.type):
+                table = table.set_column(
+                    idx, field.name,
+                    table.column(idx).cast(field.type.value_type))
+        if self.writer is not None and not table.schema.equals(self.schema):
+            self.writer.close()
+            self.writer = None
+        if self.writer is None:
+            path = self.task.table.spill_path(self.task, len(self.paths))
+            self.paths.append(path)
+            self.schema = table.schema
+            self.writer = pa.ipc.new_file(path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        """
+        Writes the batches still decoding and closes the part file.
+        :return: Paths of the part files
+        """
+        try:
+            while self.pending:
+                self.write(self.task.table.collect_decode(
+                    self.pending.pop(0))['DATA'])
+        except Exception:
+            self.discard()
+            raise
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return self.paths
+
+    def discard(self):
+        """
+        Discards the batches of a failed stream: frees the shared memory
+        of those still decoding (see SAPTable.discard_decode) and removes
+        the part files.
+        """
+        for f in self.pending:
+            self.task.table.discard_decode(f)
+        self.pending = []
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        for path in self.paths:
+            os.remove(path)
+        self.paths = []
 
 
 class SAPTableTask:
     """
     Defines the chunks of a SAPTable that will be downloaded.
     """
+    SUCCESS = ('OK', 'QUEUED')  # QUEUED: read, database write pending
+
     def __init__(self, table, ri, n, keep=False):
         """
         Create a task
@@ -29,54 +447,330 @@ class SAPTableTask:
         self.count = 0
         self.keep = keep
         self.data = None
+        self.parts = []  # files the data was spilled to, see SAPTable
+        self.write_rate = None  # rows / second reported by the node
+        self.write_ids = []  # the node's background writes, if queued
+        self.elapsed = None  # seconds taken to execute
+        self.delta_max = None  # largest delta_field value read
+        self.attempts = 0
+        self.failed_nodes = []  # nodes on which the task failed
 
-    def execute(self, node, sqlalchemy_cnxnstr=None):
+    def execute(self, node, sqlalchemy_cnxnstr=None, session=None):
         """
         Execute the task on its table.
         :param node: URL of the SAP node on which to execute
         :param sqlalchemy_cnxnstr: (optional) SQLAlchemy connection string to target database
+        :param session: (optional) requests Session, to reuse its
+                        connections to the node
         :return: Outcome of task execution, boolean
         """
-        # Build and send SAP node request to read
-        headers = {'Content-Type': 'application/json'}
+        req = self.request(node, sqlalchemy_cnxnstr)
+        if req is None:
+            # Seeded before the partitions were known; nothing to read
+            self.status = (node, 'OK')
+            self.elapsed = 0.
+            return True
+        url, data = req
+        http = session or requests
+
+        self.attempts += 1
+        t0 = time()
+        try:
+            if self.table.stream:
+                msg = self.read_stream(url, data, http)
+            else:
+                res = http.post(url=url, data=json.dumps(data),
+                                headers=self.table.headers())
+                msg = self.table.decode_response(
+                    res.headers.get('Content-Type', ''), res.content)
+            self.update(node, msg)
+        except Exception as e:
+            self.fail(node, e)
+        self.elapsed = time() - t0
+        return self.settle(node)
+
+    def request(self, node, sqlalchemy_cnxnstr=None):
+        """
+        Builds the SAP node request to read the task's chunk.
+        :param node: URL of the SAP node on which to execute
+        :param sqlalchemy_cnxnstr: (optional) SQLAlchemy connection string to target database
+        :return: (url, request data), or None if there is nothing to read
+        """
         data = {'cnxn_details': self.table.cnxn_details,
                 'table_name': self.table.table_name,
                 'ri': self.ri,
                 'n': self.n,
                 'where': self.table.where,
                 'vchunks': self.table.vchunks,
+                'fields': self.table.field_order(),
                 'sqlalchemy_cnxnstr': sqlalchemy_cnxnstr,
-                'keep': self.keep}
+                'keep': self.keep,
+                'fmt': self.table.fmt,
+                'vchunk_workers': self.table.vchunk_workers,
+                'fixed_width': self.table.fixed_width,
+                'writer': self.table.writer,
+                'async_write': self.table.async_write}
+        if self.table.chunk_ids:
+            data['chunk_id'] = self.chunk_id()
+            # Only a chunk attempted before, in this run or the resumed
+            # run, can have rows to clear
+            data['retry'] = (self.attempts > 0 or
+                             (self.ri, self.n) in self.table.attempted)
+            data['add_chunk_id'] = self.table.add_chunk_id
+        if self.table.delta_field is not None:
+            data['delta_field'] = self.table.delta_field
+            data['upsert_keys'] = self.table.key_fields(client=True)
         if self.table.output_tablename is not None:
             data['output_tablename'] = self.table.output_tablename
-        url = node + self.table.SAPNODE_ROUTE
+        if self.table.stream:
+            data['stream'] = True
+            data['batch_size'] = self.table.batch_size
 
-        try:
-            res = requests.post(url=url, data=json.dumps(data))
-            msg = res.json()
-            self.status = (node, msg['STATUS'])
-            self.count = int(msg['COUNT'])
-            self.timestamp = msg['TIMESTAMP']
-            if self.keep:
-                self.data = pd.read_csv(StringIO(msg['DATA']))
-        except Exception as e:
-            print('Error at task %s(%d - %d):\n%s'
-                  % (self.table.table_name, self.ri, self.ri + self.n, str(e)))
-            self.status = (node, 'FAIL')
+        if self.table.partition == 'keys':
+            if self.ri >= len(self.table.partitions):
+                return None
+            data.update(ri=0, n=self.table.partition_rows(self.ri),
+                        where=self.table.partitions[self.ri])
+        return node + self.table.SAPNODE_ROUTE, data
 
-        if self.status[1] == 'OK':
-            if self.count + self.ri >= self.table.rmax or self.count < self.n:
+    def update(self, node, msg):
+        """
+        Takes the task's results from the node's status message.
+        :param node: URL of the SAP node that replied
+        :param msg: Decoded status message, see SAPTable.decode_response
+        """
+        self.status = (node, msg['STATUS'])
+        self.count = int(msg['COUNT'])
+        self.timestamp = msg['TIMESTAMP']
+        self.write_rate = msg.get('WRITE_RATE')
+        self.write_ids = msg.get('WRITE_IDS', [])
+        self.delta_max = msg.get('DELTA_MAX')
+        if 'ERROR' in msg:
+            raise Exception(msg['ERROR'])
+        if 'PARTS' in msg:
+            self.parts = msg['PARTS']
+        elif self.keep and self.table.spill_dir is not None:
+            self.parts = [self.table.spill(self, msg['DATA'])]
+        elif self.keep:
+            self.data = msg['DATA']
+
+    def fail(self, node, e):
+        print('Error at task %s(%d - %d):\n%s'
+              % (self.table.table_name, self.ri, self.ri + self.n, str(e)))
+        self.status = (node, 'FAIL')
+
+    def settle(self, node):
+        """
+        Records the executed task against its table, advancing the table's
+        count and completion if it succeeded.
+        :param node: URL of the SAP node on which the task executed
+        :return: Outcome of task execution, boolean
+        """
+        with self.table.lock:
+            if self.attempts == 1:
+                self.table.tasks.append(self)
+            if self.status[1] not in self.SUCCESS:
+                self.failed_nodes.append(node)
+                return False
+            if self.table.partition == 'keys':
+                self.table.partitions_done += 1
+                if self.table.partitions_done >= len(self.table.partitions):
+                    self.table.complete = True
+                if self.ri == len(self.table.partitions) - 1 and \
+                        self.count < self.table.partition_rows(self.ri):
+                    self.table.exhausted = True
+            elif self.count < self.n:
+                self.table.complete = True
+                self.table.exhausted = True
+            elif self.count + self.ri >= self.table.rmax:
                 self.table.complete = True
             self.table.count += self.count
-            self.table.tasks.append(self)
+            if self.delta_max is not None:
+                self.table.delta_max = max(self.table.delta_max or '',
+                                           self.delta_max)
+        return True
+
+    def chunk_id(self):
+        """
+        Identifier of the task's chunk in the target table, (run, ri, n):
+        unique to the table's run, so other runs' rows are never cleared.
+        """
+        return '%s:%d:%d' % (self.table.run_id, self.ri, self.n)
+
+    def confirm_write(self, timeout=None, poll=1.0):
+        """
+        Waits for the node to commit the task's queued database writes and
+        settles the task's status to 'OK' or 'FAIL'.
+        :param timeout: (optional) Seconds to wait before giving up
+        :param poll: Seconds between status requests
+        :return: Outcome, boolean, or None on timeout
+        """
+        node = self.status[0]
+        t0 = time()
+        while True:
+            res = requests.post(url=node + self.table.SAPNODE_WRITE_STATUS_ROUTE,
+                                data=json.dumps({'write_ids': self.write_ids}))
+            statuses = [x['STATUS'] if x else 'FAIL'
+                        for x in res.json()['write_ids'].values()]
+            if 'QUEUED' not in statuses:
+                break
+            if timeout is not None and time() - t0 > timeout:
+                return None
+            sleep(poll)
+
+        if all(x == 'OK' for x in statuses):
+            self.status = (node, 'OK')
             return True
-        self.table.tasks.append(self)
+        print('Write failed at task %s(%d - %d)'
+              % (self.table.table_name, self.ri, self.ri + self.n))
+        self.status = (node, 'FAIL')
+        with self.table.lock:
+            self.table.count -= self.count
         return False
 
+    def read_stream(self, url, data, http=requests):
+        """
+        Reads a streamed /read response, building the dataframe batch by
+        batch as the lines arrive rather than from one json document.
+        With spill_dir, kept batches are appended to the task's part files
+        as they arrive (see SpillWriter), so the client's peak is about a
+        batch. Otherwise they are held until the stream ends and then
+        concatenated, a peak of about twice the chunk's data, which a
+        smaller chunksize bounds.
+        :param url: URL of the SAP node's read route
+        :param data: Request data, with 'stream' set
+        :param http: requests, or a requests Session
+        :return: The final status message, see end_stream
+        """
+        frames = self.new_frames()
+        msg = None
+        try:
+            with http.post(url=url, data=json.dumps(data), stream=True) as res:
+                for line in res.iter_lines():
+                    if line:
+                        msg = self.read_line(line, frames)
+        except Exception:
+            self.discard_frames(frames)
+            raise
+        return self.end_stream(msg, frames)
+
+    def new_frames(self):
+        """
+        The collector of a streamed response's batches: a list, or if the
+        task spills its kept data, a SpillWriter.
+        """
+        if self.keep and self.table.spill_dir is not None:
+            return SpillWriter(self)
+        return []
+
+    def read_line(self, line, frames):
+        """
+        Decodes one line of a streamed /read response.
+        :param line: The line, bytes or str
+        :param frames: Collector of the batches' dataframes, see new_frames
+        :return: The line's message, without its 'DATA'
+        """
+        if self.table.decode_workers and line.startswith(b'{"DATA"'):
+            # Collected in end_stream
+            frames.append(self.table.submit_decode(MIMETYPES['json'], line))
+            return {}
+        msg = decode_message(MIMETYPES['json'], line,
+                             self.table.csv_dtypes())
+        if 'DATA' in msg:
+            frames.append(self.table.apply_dtypes(msg.pop('DATA')))
+        return msg
+
+    def discard_frames(self, frames):
+        """
+        Discards the batches of a failed stream, freeing the shared memory
+        of those still decoding (see SAPTable.discard_decode).
+        :param frames: The batches' dataframes, or decoding futures, or a
+                       SpillWriter
+        """
+        if isinstance(frames, SpillWriter):
+            frames.discard()
+            return
+        if self.table.decode_workers:
+            for f in frames:
+                self.table.discard_decode(f)
+        del frames[:]
+
+    def end_stream(self, msg, frames):
+        """
+        Checks a streamed response ended with its status message.
+        :param msg: The last line's message
+        :param frames: The batches' dataframes, or with decode_workers
+                       their decoding futures, or a SpillWriter
+        :return: The status message, with the concatenated batches in
+                 'DATA' if the task keeps its data, or the part files they
+                 were spilled to in 'PARTS'
+        """
+        if isinstance(frames, SpillWriter):
+            if msg is None or 'STATUS' not in msg or 'ERROR' in msg:
+                frames.discard()
+                frames = []
+            else:
+                msg['PARTS'] = frames.close()
+        elif self.table.decode_workers:
+            futures, frames = frames, []
+            try:
+                for f in futures:
+                    frames.append(self.table.collect_decode(f)['DATA'])
+            except Exception:
+                # collect_decode frees its own block; free the others'
+                self.discard_frames(futures[len(frames) + 1:])
+                raise
+        if msg is None or 'STATUS' not in msg:
+            raise Exception('Stream ended without a status')
+        if self.keep and 'PARTS' not in msg:
+            msg['DATA'] = (pd.concat(frames, ignore_index=True)
+                           if frames else pd.DataFrame())
+        return msg
+
 
 class SAPTable:
     """
 
+    With partition='keys', the table is read in ranges of its primary key
+    rather than by ROWSKIPS: key values sampled every chunksize rows (up to
+    rmax) bound the ranges, each task reads one range with a where clause,
+    and a task's ri is its partition index. The last range, open-ended,
+    is capped at the rows left of rmax. The ranges assume the database's
+    binary sort order, which SAP requires.
+
+    With a delta_field (e.g. a change date, AEDAT), the table is extracted
+    incrementally: only rows with delta_field at or past the high-water
+    mark of the last complete run are read, and they are upserted on the
+    table's key, so the key fields must be among the fields read. The new
+    mark, the largest delta_field value read, is stored in watermarks
+    (a WatermarkStore) once the run reads to the end of the table without
+    failures; a run stopped by rmax keeps the old mark. Rows deleted in
+    SAP are not propagated.
+
+    With a meta_cache (a MetaCache), metadata is looked up there before
+    asking a node, and stored there after.
+
+    With dtypes='infer', downloaded columns are cast to dtypes inferred
+    from the table's metadata (see infer_dtypes) as they are decoded.
+
+    With decode_workers, kept data is decoded in that many processes
+    (shared by all tables, see get_decode_pool) rather than on the thread
+    that fetched it, and handed back through shared memory. This needs
+    pyarrow.
+
+    With spill_dir, each task's kept data is written to a Feather part
+    file there as the task completes, or if streamed, batch by batch as it
+    arrives (see SpillWriter), instead of being held in memory; see
+    iter_downloaded_dataframes and get_downloaded_dataframe.
+
+    Chunks recorded as committed in committed (see csapx.TaskLedger) are
+    skipped, so an interrupted extraction resumes where it stopped. With
+    chunk_ids, each chunk's rows carry a CHUNK_ID column, identifying the
+    chunk within the run (run_id), and a chunk read again in the same run
+    (a retry, or a chunk in attempted, which the resumed run started)
+    replaces its earlier rows. An existing target table without a CHUNK_ID
+    column is written without chunk ids, unless add_chunk_id is set, in
+    which case the node adds the column.
     """
     PREREQ_MISSING = 0
     PREREQ_PENDING = 1
@@ -84,11 +778,20 @@ class SAPTable:
     SAPNODE_ROUTE = '/read'  # POST
     SAPNODE_META_ROUTE = '/meta'   # GET
     SAPNODE_CONNECTION_ROUTE = '/info'  # POST, GET
+    SAPNODE_WRITE_STATUS_ROUTE = '/write_status'  # POST, GET
+    SAPNODE_BOUNDARIES_ROUTE = '/boundaries'  # POST
     SAP_BUFFER_SIZE = 400
+    ADAPT_WINDOW = 5  # completed tasks that adaptive chunk sizing looks at
 
     def __init__(self, system, auth, table_name, fields=None, r0=0, rmax=1000,
                  chunksize=10000, where='', output_tablename=None, keep=False,
-                 dtypes=None):
+                 dtypes=None, stream=False, batch_size=10000, fmt='json',
+                 vchunk_workers=1, fixed_width=False, writer='default',
+                 async_write=False, adaptive=False, target_seconds=30.,
+                 target_bytes=50e6, chunksize_min=1000, chunksize_max=1000000,
+                 partition='rows', delta_field=None, watermarks=None,
+                 decode_workers=0, spill_dir=None, meta_cache=None,
+                 add_chunk_id=False):
         self.table_name = table_name
         self.fields = fields
         self.cnxn_details = {'ashost': system[0],
@@ -101,16 +804,89 @@ class SAPTable:
         self.rmax = rmax
         self.chunksize = chunksize
         self.meta_status = 0
+        self.meta_cond = Condition()  # notified as meta_status changes
+        self.meta_cache = meta_cache
         self.where = where
         self.count = 0
         self.dtypes = dtypes
+        self.sap_dtypes = None  # with dtypes='infer', see infer_dtypes
         self.output_tablename = output_tablename
         self.keep = keep
+        self.stream = stream
+        self.batch_size = batch_size
+        self.fmt = fmt
+        self.vchunk_workers = vchunk_workers
+        self.fixed_width = fixed_width
+        self.writer = writer
+        self.async_write = async_write
+        self.adaptive = adaptive
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.chunksize_min = chunksize_min
+        self.chunksize_max = chunksize_max
+        self.partition = partition
+        self.decode_workers = decode_workers
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.partitions = None  # where clauses, in partition='keys' mode
+        self.partitions_done = 0
+        self.delta_field = delta_field
+        self.watermarks = watermarks
+        self.watermark = None
+        self.delta_max = None
+        self.committed = {}  # ri: (n, count) of chunks already extracted
+        self.chunk_ids = False
+        self.add_chunk_id = add_chunk_id
+        self.attempted = set()  # (ri, n) of chunks the resumed run started
+        self.run_id = uuid.uuid4().hex  # or the resumed run's, see TaskLedger
+        if delta_field is not None:
+            if self.watermarks is None:
+                self.watermarks = WatermarkStore()
+            self.watermark = self.watermarks.get(self.table_key())
+            if self.watermark is not None:
+                delta = "%s >= '%s'" % (delta_field, self.watermark)
+                self.where = '( %s ) AND %s' % (where, delta) if where else delta
 
         self.complete = False
+        self.exhausted = False  # a chunk came back short: no rows are left
         self.vchunks = None
+        self.rfc_calls = None  # RFC calls per task, one per vchunk
         self.meta = None
         self.tasks = []
+        self.lock = Lock()  # tasks execute in concurrent worker threads
+
+    def table_key(self):
+        """
+        Key identifying the table's extraction, for its high-water mark and
+        ledger entries: source system, client, table and target table.
+        """
+        return '|'.join([self.cnxn_details['ashost'],
+                         self.cnxn_details['client'], self.table_name,
+                         self.output_tablename or self.table_name])
+
+    def succeeded(self):
+        """
+        Whether the table completed and every task (and its database
+        write) succeeded.
+        """
+        return self.complete and all(t.status[1] == 'OK' for t in self.tasks)
+
+    def commit_watermark(self):
+        """
+        Stores the largest delta_field value read as the next run's
+        high-water mark, if the table completed and every task (and its
+        database write) succeeded, and the run read to the end of the
+        table rather than stopping at rmax, which would skip the rows left
+        below the mark.
+        :return: The stored mark, or None if not stored
+        """
+        if self.delta_field is None or self.delta_max is None or \
+                not self.succeeded() or not self.exhausted:
+            return None
+        self.watermarks.set(self.table_key(), self.delta_max)
+        self.watermark = self.delta_max
+        return self.delta_max
 
     def connection_test(self, node):
         """
@@ -123,19 +899,253 @@ class SAPTable:
                                              self.cnxn_details}))
         return json.loads(res.text)
 
+    def headers(self):
+        """
+        Request headers for the node, accepting the table's format.
+        """
+        return {'Content-Type': 'application/json',
+                'Accept': MIMETYPES[self.fmt]}
+
+    def csv_dtypes(self):
+        """
+        dtypes for read_csv: strings, if dtypes are inferred, so that
+        apply_dtypes casts from SAP's text.
+        """
+        return str if self.dtypes == 'infer' else self.dtypes
+
+    def apply_dtypes(self, df):
+        """
+        Casts the columns named in the table's dtypes, or with
+        dtypes='infer', the columns of the dtypes inferred from the
+        table's metadata (see infer_dtypes).
+        :param df: Downloaded dataframe
+        :return: Dataframe with dtypes applied
+        """
+        if self.dtypes == 'infer':
+            for col, dtype in (self.sap_dtypes or {}).items():
+                if col in df.columns:
+                    df[col] = cast_sap(df[col], dtype)
+            return df
+        if not self.dtypes:
+            return df
+        return df.astype({k: v for k, v in self.dtypes.items()
+                          if k in df.columns})
+
+    def decode_response(self, content_type, content):
+        """
+        Decodes a /read response in whichever format the node replied with.
+        :param content_type: Response Content-Type header
+        :param content: Response body, bytes
+        :return: The status message, with the dataframe in 'DATA' if the
+                 table keeps its data
+        """
+        if self.decode_workers and self.keep:
+            return self.collect_decode(self.submit_decode(content_type,
+                                                          content))
+        msg = decode_message(content_type, content, self.csv_dtypes(),
+                             self.keep)
+        if self.keep:
+            msg['DATA'] = self.apply_dtypes(msg['DATA'])
+        return msg
+
+    def submit_decode(self, content_type, content):
+        """
+        Submits a response, or a line of a streamed one, to the decoding
+        processes.
+        :return: Future, see collect_decode
+        """
+        return get_decode_pool(self.decode_workers).submit(
+            decode_shared, content_type, content, self.csv_dtypes())
+
+    def collect_decode(self, future):
+        """
+        Waits for a decoding process.
+        :param future: Future from submit_decode
+        :return: The status message, with the dataframe in 'DATA'
+        """
+        msg = attach_shared(*future.result())
+        msg['DATA'] = self.apply_dtypes(msg['DATA'])
+        return msg
+
+    def discard_decode(self, future):
+        """
+        Waits for a decoding process and frees its shared memory block,
+        discarding the data.
+        :param future: Future from submit_decode
+        """
+        try:
+            msg, name, size = future.result()
+        except Exception:
+            return  # decode_shared freed the block
+        if name is not None:
+            shm = SharedMemory(name=name)
+            shm.close()
+            shm.unlink()
+
     def get_next_task(self):
         """
         Get the next TableTask, ie. the next row-wise chunk
         Useful for chunking / looping through rows.
         Updates the ri_next attribute of the table, the start of the next chunk.
+        If the table is adaptive, the chunksize is adapted first.
         :return: TableTask for the next batch
         """
-        if self.ri_next < self.rmax:
-            t = SAPTableTask(self, self.ri_next, self.chunksize, keep=self.keep)
-            self.ri_next += self.chunksize
-            return t
+        with self.lock:
+            if self.partition == 'keys':
+                return self.get_next_partition_task()
+            if self.adaptive:
+                self.chunksize = self.adapt_chunksize()
+            while self.ri_next in self.committed:
+                n, count = self.committed.pop(self.ri_next)
+                self.count += count
+                if count + self.ri_next >= self.rmax or count < n:
+                    self.complete = True
+                    self.exhausted = count < n
+                    return None
+                self.ri_next += n
+            if self.ri_next < self.rmax:
+                # Stop short of the next committed chunk
+                n = min([self.chunksize] + [ri - self.ri_next
+                                            for ri in self.committed
+                                            if ri > self.ri_next])
+                t = SAPTableTask(self, self.ri_next, n, keep=self.keep)
+                self.ri_next += n
+                return t
+            else:
+                return None
+
+    def get_next_partition_task(self):
+        """
+        Get the task for the next key range, in partition='keys' mode.
+        Before the partitions are known, tasks are handed out up to the
+        most partitions that sampling can produce.
+        :return: TableTask for the next key range
+        """
+        if self.partitions is not None:
+            limit = len(self.partitions)
         else:
+            limit = -(-self.rmax // self.chunksize)
+        while self.ri_next in self.committed:
+            count = self.committed.pop(self.ri_next)[1]
+            self.count += count
+            self.partitions_done += 1
+            if self.partitions_done >= limit:
+                self.complete = True
+            if self.partitions is not None and self.ri_next == limit - 1 \
+                    and count < self.partition_rows(self.ri_next):
+                self.exhausted = True
+            self.ri_next += 1
+        if self.ri_next < limit:
+            t = SAPTableTask(self, self.ri_next, 0, keep=self.keep)
+            self.ri_next += 1
+            return t
+        return None
+
+    def field_order(self):
+        """
+        The fields read, as the node returns them: in the order of fields,
+        or of the table (meta.POSITION) if fields is None.
+        :return: List of field names
+        """
+        if self.fields is not None:
+            return [f.upper() for f in self.fields]
+        meta = self.meta.sort_values('POSITION')
+        return meta[meta.FIELDNAME.isin(set(f for vchunk in self.vchunks
+                                                for f in vchunk))
+                    ].FIELDNAME.tolist()
+
+    def key_fields(self, client=False):
+        """
+        The table's key fields in key order, from the metadata's KEYFLAG.
+        :param client: Include the client (MANDT), which the RFC fixes
+                       but a target table may hold several of
+        :return: List of field names
+        """
+        meta = self.meta.sort_values('POSITION')
+        keys = meta[meta.KEYFLAG == 'X'].FIELDNAME.tolist()
+        return [k for k in keys if client or k != 'MANDT']
+
+    def get_partitions(self, node):
+        """
+        Samples key values from node/SAPNODE_BOUNDARIES_ROUTE and splits
+        the table into key ranges between them.
+        :param node: URL of the SAP node on which to sample
+        :return: List of where clauses, one per key range
+        """
+        key_fields = self.key_fields()
+        if not key_fields:
+            raise TableError('%s has no key fields to partition by'
+                             % self.table_name)
+        res = requests.post(url=node + self.SAPNODE_BOUNDARIES_ROUTE,
+                            data=json.dumps({'cnxn_details': self.cnxn_details,
+                                             'table_name': self.table_name,
+                                             'key_fields': key_fields,
+                                             'where': self.where,
+                                             'rmax': self.rmax,
+                                             'step': self.chunksize}))
+        boundaries = sorted(set(tuple(b) for b in res.json()['boundaries']))
+
+        edges = [None] + boundaries + [None]
+        partitions = []
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            conditions = ['( %s )' % self.where] if self.where else []
+            if lo is not None:
+                conditions.append(key_bound(key_fields, lo, '>='))
+            if hi is not None:
+                conditions.append(key_bound(key_fields, hi, '<'))
+            partitions.append(' AND '.join(conditions))
+        self.partitions = partitions
+        return partitions
+
+    def partition_rows(self, idx):
+        """
+        Rows to read from key range idx, in partition='keys' mode: all of
+        it (0), bar the last range, which has no upper bound and is capped
+        at the rows of rmax that the chunksize-row ranges before it leave.
+        :param idx: Index of the key range
+        :return: Number of rows, 0 for the whole range
+        """
+        if idx < len(self.partitions) - 1:
+            return 0
+        return max(1, self.rmax - idx * self.chunksize)
+
+    def row_width(self):
+        """
+        The width of a downloaded row in characters, from meta.LENG.
+        :return: Row width, or None before the metadata is fetched
+        """
+        if self.meta is None or not self.vchunks:
             return None
+        fields = set(f.upper() for vchunk in self.vchunks for f in vchunk)
+        return int(self.meta[self.meta.FIELDNAME.isin(fields)].LENG.sum())
+
+    def adapt_chunksize(self):
+        """
+        Adapts the chunksize toward tasks that take target_seconds and
+        carry at most target_bytes, from the rows / second of the last
+        ADAPT_WINDOW completed tasks and the row width. A failed last task
+        halves it. Each step at most doubles or halves the chunksize, and
+        it stays within [chunksize_min, chunksize_max].
+        :return: The new chunksize
+        """
+        done = [t for t in self.tasks if t.elapsed]
+        if not done:
+            return self.chunksize
+        if done[-1].status[1] not in SAPTableTask.SUCCESS:
+            n = self.chunksize / 2.
+        else:
+            recent = [t for t in done if t.status[1] in SAPTableTask.SUCCESS
+                      and t.count > 0][-self.ADAPT_WINDOW:]
+            if not recent:
+                return self.chunksize
+            rate = (sum(t.count for t in recent) /
+                    sum(t.elapsed for t in recent))
+            n = self.target_seconds * rate
+            row_width = self.row_width()
+            if row_width:
+                n = min(n, self.target_bytes / row_width)
+        n = max(self.chunksize / 2., min(self.chunksize * 2., n))
+        return int(max(self.chunksize_min, min(self.chunksize_max, n)))
 
     def get_task(self, ri=0, n=1000000):
         """
@@ -148,51 +1158,201 @@ class SAPTable:
 
     def prerequisites(self, node):
         """
-        Prepares the table for download, fetching metadata.
+        Prepares the table for download, fetching metadata. Threads
+        arriving while another fetches it wait to be notified.
         :param node:
         :return:
         """
-        while self.meta_status != self.PREREQ_SUCCESS:
-            if self.meta_status == self.PREREQ_PENDING:
+        with self.meta_cond:
+            while self.meta_status == self.PREREQ_PENDING:
                 # wait for metadata task to complete
-                sleep(2)
-            elif self.meta_status == self.PREREQ_MISSING:
-                # fetch the metadata
-                self.meta_status = self.PREREQ_PENDING
-                self.get_meta(node)
-                self.meta_status = self.PREREQ_SUCCESS
+                self.meta_cond.wait()
+            if self.meta_status == self.PREREQ_SUCCESS:
+                return
+            self.meta_status = self.PREREQ_PENDING
+
+        # fetch the metadata
+        status = self.PREREQ_MISSING  # let the next task try again
+        try:
+            self.get_meta(node)
+            status = self.PREREQ_SUCCESS
+        finally:
+            with self.meta_cond:
+                self.meta_status = status
+                self.meta_cond.notify_all()
+
+    def meta_key(self):
+        """
+        Key of the table's metadata in meta_cache.
+        """
+        return [self.cnxn_details['ashost'], self.cnxn_details['sysnr'],
+                self.cnxn_details['client'], self.table_name, self.fields,
+                self.fixed_width, self.SAP_BUFFER_SIZE]
 
     def get_meta(self, node):
         """
-        Fetches the metadata of the table from node/SAPNODE_META_ROUTE
+        Fetches the metadata of the table from meta_cache, if it holds it,
+        or from node/SAPNODE_META_ROUTE
         :param node: URL of the SAP node on which to run the job
         :return: Dataframe containing metadata
         """
+        cached = None
+        if self.meta_cache is not None:
+            cached = self.meta_cache.get(self.meta_key())
+        if cached is not None:
+            self.meta, self.vchunks = cached
+        else:
+            self.meta, self.vchunks = self.request_meta(node)
+            if self.meta_cache is not None:
+                self.meta_cache.set(self.meta_key(), self.meta, self.vchunks)
+
+        self.rfc_calls = len(self.vchunks)
+        for col in ('POSITION', 'INTLEN', 'LENG'):
+            self.meta[col] = self.meta[col].astype(int)
+        if self.dtypes == 'infer':
+            self.sap_dtypes = infer_dtypes(self.meta)
+        if self.partition == 'keys' and self.partitions is None:
+            self.get_partitions(node)
+        self.meta_status = self.PREREQ_SUCCESS
+        return self.meta
+
+    def request_meta(self, node):
+        """
+        Requests the metadata of the table from node/SAPNODE_META_ROUTE
+        :param node: URL of the SAP node on which to run the job
+        :return: (metadata dataframe, vchunks)
+        :raises TableError: if the node finds no such table or fields
+        """
         # Send request to SAP node
         res = requests.post(url=node + self.SAPNODE_META_ROUTE,
                             data=json.dumps({'cnxn_details': self.cnxn_details,
                                              'table_name': self.table_name,
                                              'fields': self.fields,
-                                             'sap_buffer_size': self.SAP_BUFFER_SIZE}))
+                                             'sap_buffer_size': self.SAP_BUFFER_SIZE,
+                                             'fmt': self.fmt,
+                                             'fixed_width': self.fixed_width}),
+                            headers=self.headers())
+        if res.status_code == 400:
+            raise TableError(res.json()['ERROR'])
 
-        resjson = res.json()
-        self.vchunks = resjson['vchunks']
-        self.meta = pd.read_csv(StringIO(resjson['meta_csv']))
-        self.meta.LENG = self.meta.LENG.astype(int)
-        self.meta_status = self.PREREQ_SUCCESS
-        return self.meta
+        content_type = res.headers.get('Content-Type', '')
+        if content_type.startswith(MIMETYPES['json']) or \
+                content_type.startswith('text/'):
+            resjson = res.json()
+            meta = pd.read_csv(StringIO(resjson['meta_csv']))
+        else:
+            meta, resjson = decode_frame(res.content, content_type)
+        return meta, resjson['vchunks']
+
+    def confirm_writes(self, timeout=None):
+        """
+        Waits for the table's queued database writes (see async_write).
+        :param timeout: (optional) Seconds to wait per task
+        :return: True if every queued write committed
+        """
+        return all([t.confirm_write(timeout) for t in self.tasks
+                    if t.status[1] == 'QUEUED'])
+
+    def spill_path(self, task, part=0):
+        """
+        Path of a task's part file in spill_dir. Part files are named by
+        the table name, made safe for a file name (eg. /BIC/AZSD00100),
+        and a digest of the table's key, where clause and fields, so
+        tables sharing a spill_dir keep apart.
+        :param task: SAPTableTask
+        :param part: Index of the task's part file
+        """
+        digest = hashlib.sha1(json.dumps(
+            [self.table_key(), self.where, self.fields]).encode('utf-8'))
+        return os.path.join(self.spill_dir, '%s_%s_%d_%d_%d.feather'
+                            % (re.sub(r'[^\w.-]', '_', self.table_name),
+                               digest.hexdigest()[:12], task.ri, task.n,
+                               part))
+
+    def spill(self, task, df):
+        """
+        Writes a task's data to a part file in spill_dir.
+        :param task: SAPTableTask
+        :param df: The task's data
+        :return: Path of the part file
+        """
+        path = self.spill_path(task)
+        feather.write_feather(df, path, compression='uncompressed')
+        return path
+
+    def restore_categories(self, df):
+        """
+        Casts columns inferred as categories (see infer_dtypes) back to
+        categories, where concatenating parts or spilling them as values
+        (see SpillWriter) left objects.
+        :param df: Downloaded dataframe
+        :return: The dataframe
+        """
+        for col, dtype in (self.sap_dtypes or {}).items():
+            if dtype == 'category' and col in df.columns and \
+                    df[col].dtype != 'category':
+                df[col] = cast_sap(df[col], dtype)
+        return df
+
+    def iter_downloaded_dataframes(self, task_idxs=None):
+        """
+        Iterates over tasks' data one task at a time, reading spilled data
+        back from the task's part files one at a time.
+        :param task_idxs: (optional) The tasks to iterate over
+        :return: Generator of dataframes
+        """
+        if not task_idxs:
+            task_idxs = range(len(self.tasks))
+        for idx in task_idxs:
+            task = self.tasks[idx]
+            for part in task.parts:
+                yield self.restore_categories(feather.read_feather(part))
+            if task.data is not None:
+                yield task.data
 
     def get_downloaded_dataframe(self, task_idxs=None, drop_duplicates=True):
         """
         Concatenate tasks' data into a single dataframe
+        Spilled parts are memory-mapped and concatenated as Arrow tables,
+        so the dataframe is built in one copy rather than from a copy per
+        part.
+        Duplicates are found by hashing the table's key fields (KEYFLAG),
+        if it has metadata and they were downloaded, otherwise by
+        comparing every field but the timestamp.
         :param task_idxs: (optional) The tasks to concatenate
         :param drop_duplicates: Drop duplicates from resulting dataframe
         :return:
         """
         if not task_idxs:
             task_idxs = range(len(self.tasks))
-        dfout = pd.concat([self.tasks[idx].data for idx in task_idxs])
+        tasks = [self.tasks[idx] for idx in task_idxs]
+        if self.spill_dir is not None:
+            try:
+                table = pa.concat_tables(
+                    [feather.read_table(part, memory_map=True)
+                     for t in tasks for part in t.parts])
+                dfout = table.to_pandas(split_blocks=True, self_destruct=True)
+                del table
+            except pa.ArrowInvalid:
+                # parts inferred different types for a field
+                dfout = pd.concat(self.iter_downloaded_dataframes(task_idxs),
+                                  ignore_index=True)
+        else:
+            dfout = pd.concat([t.data for t in tasks if t.data is not None],
+                              ignore_index=True)
         dfout.reset_index(drop=True, inplace=True)
+        self.restore_categories(dfout)
         if drop_duplicates:
-            dfout.drop_duplicates(inplace=True, subset=dfout.columns[:-1])
+            keys = []
+            if self.meta is not None:
+                keys = [k for k in self.key_fields(client=True)
+                        if k in dfout.columns]
+            if keys:
+                hashes = pd.util.hash_pandas_object(dfout[keys], index=False)
+                dfout = dfout[~hashes.duplicated().values]
+                dfout.reset_index(drop=True, inplace=True)
+            else:
+                dfout.drop_duplicates(inplace=True, subset=[
+                    c for c in dfout.columns
+                    if c not in ('TIMESTAMP', 'CHUNK_ID')])
         return dfout
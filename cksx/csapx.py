@@ -2,6 +2,172 @@
 """
 
 """
+from queue import Queue
+from threading import Thread, Lock, Timer
+from time import sleep, time
+from datetime import datetime
+import json
+import random
+import sqlite3
+import sys
+import requests
+from csap import TableError
+
+
+class NodeStats:
+    """
+    Measured performance of a SAP node: its rows / second per task and its
+    error rate, as exponentially weighted moving averages over completed
+    tasks.
+    Also the node's circuit breaker: after BREAKER_FAILURES consecutive
+    failures the breaker opens and the node is taken out of rotation for
+    BREAKER_COOLDOWN seconds. It then gets one task at a time until a
+    task succeeds, which closes the breaker, or fails, which reopens it.
+    """
+    ALPHA = 0.3  # weight of the latest task
+    BREAKER_FAILURES = 3
+    BREAKER_COOLDOWN = 30.  # seconds
+
+    def __init__(self):
+        self.rate = None  # rows / second, None until measured
+        self.error_rate = 0.
+        self.tasks = 0
+        self.rows = 0
+        self.consecutive_failures = 0
+        self.open_until = None  # while the breaker is open
+        self.lock = Lock()
+
+    def record(self, rows, seconds, ok):
+        """
+        Records a completed task.
+        :param rows: Number of rows the task read
+        :param seconds: Time the task took
+        :param ok: Outcome of the task, boolean
+        """
+        with self.lock:
+            self.tasks += 1
+            self.error_rate += self.ALPHA * ((0. if ok else 1.) - self.error_rate)
+            if ok:
+                self.consecutive_failures = 0
+                self.open_until = None
+            else:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= self.BREAKER_FAILURES:
+                    self.open_until = time() + self.BREAKER_COOLDOWN
+            if ok and rows > 0 and seconds > 0:
+                self.rows += rows
+                rate = rows / seconds
+                if self.rate is None:
+                    self.rate = rate
+                else:
+                    self.rate += self.ALPHA * (rate - self.rate)
+
+    def breaker(self):
+        """
+        :return: The breaker's state: 'closed', 'open' or 'half-open'
+        """
+        if self.open_until is None:
+            return 'closed'
+        return 'open' if time() < self.open_until else 'half-open'
+
+
+class TaskLedger:
+    """
+    Durable record of SAPTableTasks in a SQLite database, by run: each
+    table's extraction is a run, 'open' until it succeeds and 'done' after
+    (see close). A run holds the table's key partitions, and each task's
+    state ('Created', 'running', then its status: 'OK', 'QUEUED' or
+    'FAIL'), node, row count and time, keyed by (run, ri, n).
+    An Extractor with a ledger resumes its tables' open runs from it, and
+    starts a new run for tables without one.
+    """
+    def __init__(self, path='ledger.sqlite'):
+        self.path = path
+        self.lock = Lock()
+        self.cnxn = sqlite3.connect(path, check_same_thread=False)
+        with self.cnxn:
+            self.cnxn.execute('CREATE TABLE IF NOT EXISTS runs ('
+                              'run_id TEXT PRIMARY KEY, table_key TEXT, '
+                              'state TEXT, partitions TEXT, '
+                              'started TEXT, finished TEXT)')
+            self.cnxn.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                              'run_id TEXT, table_key TEXT, ri INTEGER, '
+                              'n INTEGER, state TEXT, node TEXT, '
+                              'count INTEGER, timestamp TEXT, '
+                              'PRIMARY KEY (run_id, ri, n))')
+
+    def record(self, task, state=None):
+        """
+        Records a task's state.
+        :param task: SAPTableTask
+        :param state: (optional) State, by default the task's status
+        """
+        node, status = task.status
+        with self.lock, self.cnxn:
+            self.cnxn.execute('INSERT OR REPLACE INTO tasks VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?, ?)',
+                              (task.table.run_id, task.table.table_key(),
+                               task.ri, task.n,
+                               state or status, node, task.count,
+                               datetime.utcnow().isoformat()))
+
+    def record_partitions(self, table):
+        """
+        Records a table's key partitions (see SAPTable partition='keys'),
+        once, so that a resumed extraction reads the same ranges.
+        """
+        if table.partitions is None:
+            return
+        with self.lock, self.cnxn:
+            self.cnxn.execute('UPDATE runs SET partitions = ? WHERE '
+                              'run_id = ? AND partitions IS NULL',
+                              (json.dumps(table.partitions), table.run_id))
+
+    def resume(self, table):
+        """
+        Resumes the table's open run, if it has one: sets the table's
+        run_id, and loads the run's committed tasks and partitions into
+        the table, so that it skips them (see SAPTable.committed), and its
+        other tasks, so that their rows are cleared before they are read
+        again (see SAPTable.attempted).
+        Otherwise records the table's run_id as a new open run.
+        :param table: SAPTable
+        :return: Number of committed tasks
+        """
+        with self.lock, self.cnxn:
+            run = self.cnxn.execute("SELECT run_id, partitions FROM runs "
+                                    "WHERE table_key = ? AND state = 'open' "
+                                    'ORDER BY started DESC',
+                                    (table.table_key(),)).fetchone()
+            if run is None:
+                self.cnxn.execute("INSERT INTO runs VALUES "
+                                  "(?, ?, 'open', NULL, ?, NULL)",
+                                  (table.run_id, table.table_key(),
+                                   datetime.utcnow().isoformat()))
+                return 0
+            table.run_id, partitions = run
+            rows = self.cnxn.execute('SELECT ri, n, count, state FROM tasks '
+                                     'WHERE run_id = ?',
+                                     (table.run_id,)).fetchall()
+        if partitions is not None:
+            table.partitions = json.loads(partitions)
+        table.committed = {ri: (n, count) for ri, n, count, state in rows
+                           if state == 'OK'}
+        table.attempted = set((ri, n) for ri, n, count, state in rows
+                              if state != 'OK')
+        return len(table.committed)
+
+    def close(self, table):
+        """
+        Marks the table's run 'done', so the next extraction of the table
+        starts a new run rather than resuming it. Its tasks stay recorded.
+        :param table: SAPTable
+        """
+        with self.lock, self.cnxn:
+            self.cnxn.execute("UPDATE runs SET state = 'done', finished = ? "
+                              'WHERE run_id = ?',
+                              (datetime.utcnow().isoformat(), table.run_id))
+
 
 class Worker(Thread):
     """
@@ -9,53 +175,84 @@ class Worker(Thread):
     Subclass Thread to create workers that add to a common queue after
     completing their task.
     """
-    def __init__(self, queue, node):
+    def __init__(self, queue, node, slot=0):
         """
         Initialise a Worker object.
         :param queue: Extractor object (contains the queue that the worker
                       gets and puts).
         :param node: The URL of the SAP node which the worker will query.
+        :param slot: Index of the worker among its node's workers; slots
+                     beyond the node's allowance (Extractor.node_slots)
+                     stay idle.
         :return:
         """
         Thread.__init__(self)
         self.queue = queue
         self.node = node
-        self.Daemon = True
+        self.slot = slot
+        self.daemon = True
         self.status = True
         self.sqlalchemy_cnxnstr = queue.sqlalchemy_cnxnstr
+        self.session = requests.Session()  # keeps the node connection alive
 
     def run(self):
         """
         Overloads Thread.run, defining the processing flow of each Worker Thread.
-        (1) Get a task from the Extractor Queue
-        (2) Check prerequisites are met for the task
-        (3) Execute the task
-        (4) Get the next task, or look to the next table in the Extractor
-            if the current table is complete.
+        (1) Wait while the node's allowance excludes this worker's slot
+        (2) Get a task from the Extractor Queue, leaving tasks that failed
+            on this node to other nodes
+        (3) Check prerequisites are met for the task, counting a failure
+            as an attempt; the node's stats skip errors in the table itself
+        (4) Execute the task, recording the node's performance
+        (5) Put the next task, from whichever table is due one
+        (6) Retry the task if it failed.
         """
         while True:
+            if self.slot >= self.queue.node_slots(self.node):
+                sleep(self.queue.THROTTLE_SLEEP)
+                continue
+
             # Get a task from the queue
             task = self.queue.get()
+            if self.queue.avoid(task, self.node):
+                self.queue.put(task)
+                self.queue.task_done()
+                sleep(self.queue.HANDOFF_SLEEP)
+                continue
 
-            # check the table prerequisites are satisfied
-            task.table.prerequisites(self.node)
-
-            # execute the task
-            if task.execute(self.node, self.sqlalchemy_cnxnstr) is False:
-                self.status = False
+            ledger = self.queue.ledger
+            node_failed = True
+            try:
+                # check the table prerequisites are satisfied
+                task.table.prerequisites(self.node)
+            except Exception as e:
+                node_failed = self.queue.prerequisites_failed(task, self.node,
+                                                              e)
+                ok = False
+            else:
+                # execute the task
+                if ledger is not None:
+                    ledger.record_partitions(task.table)
+                    ledger.record(task, 'running')
+                ok = task.execute(self.node, self.sqlalchemy_cnxnstr,
+                                  self.session)
+            if ledger is not None:
+                ledger.record(task)
+            if node_failed:
+                self.queue.node_stats[self.node].record(task.count,
+                                                        task.elapsed, ok)
 
-            # If there are more tasks for the table put one onto the queue
-            # before completing.
-            next_task = task.table.get_next_task()
+            # Replace the task before completing, so the queue is not left
+            # empty while tables remain.
+            next_task = self.queue.get_next_incomplete_table_task()
             if next_task is not None:
-                self.queue.put(next_task, block=False)
+                self.queue.schedule(next_task)
 
-            # If the table is complete, seed this worker with the next
-            # incomplete table's task.
+            if ok is False:
+                self.status = False
+                self.queue.retry(task)
             else:
-                next_tables_task = self.queue.get_next_incomplete_table_task()
-                if next_tables_task is not None:
-                    self.queue.put(next_task, block=False)
+                self.queue.finished(task)
 
             # Task is complete
             self.queue.task_done()
@@ -67,13 +264,45 @@ class Extractor(Queue):
     The Extractor seeds an initial queue of SAPTableTasks from the SAPTables
     attached to it. Workers execute the initial queue, and put to the queue
     when each task completes, until all SAPTables are complete.
+    Each node runs up to tasks_per_node workers off the shared queue, so
+    faster nodes take more of the work. Nodes that are slower per task than
+    the fastest node, or that fail, are allowed proportionally fewer
+    concurrent tasks. Replacement tasks go to the table with the fewest
+    tasks in flight.
+    Failed tasks are retried up to max_attempts times, after a capped
+    exponential backoff with full jitter, preferably on a node they have
+    not failed on; tasks out of attempts are kept in dead_letters. Nodes
+    failing repeatedly are taken out of rotation (see NodeStats).
+    With a TaskLedger, tasks are recorded as they run and tables resume
+    their open run from the ledger, skipping chunks already committed. A
+    run is closed once its table succeeds, so the next extraction starts
+    afresh.
+    With a ledger, or retries (max_attempts > 1), chunks are written with
+    chunk ids, so a chunk re-run after failing part way through its write
+    replaces its rows rather than duplicating them. Only re-run chunks
+    delete rows first, and existing target tables are only altered to
+    hold chunk ids if the table sets add_chunk_id (see SAPTable).
     """
+    THROTTLE_SLEEP = 1.0  # seconds an idle worker waits before rechecking
+    HANDOFF_SLEEP = 0.1  # seconds a worker waits after handing a task back
+
     def __init__(self, nodes=None, start=True,
-                 sqlalchemy_cnxnstr='sqlite:///db.sqlite'):
+                 sqlalchemy_cnxnstr='sqlite:///db.sqlite', tasks_per_node=1,
+                 ledger=None, max_attempts=5, backoff_base=1.,
+                 backoff_cap=60.):
         Queue.__init__(self)
         self.nodes = nodes or self.default_nodes
         self.tables = []
         self.sqlalchemy_cnxnstr = sqlalchemy_cnxnstr
+        self.tasks_per_node = tasks_per_node
+        self.node_stats = {node: NodeStats() for node in self.nodes}
+        self.in_flight = {}  # table: number of tasks queued or executing
+        self.schedule_lock = Lock()
+        self.ledger = ledger
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.dead_letters = []  # tasks that ran out of attempts
         self.workers = None
         if start:
             self.start()
@@ -84,7 +313,8 @@ class Extractor(Queue):
         Only starts workers that pass cnxn_test.
         """
         self.nodes[:] = [x for x in self.nodes if self.cnxn_test(x)]
-        self.workers = [Worker(self, node) for node in self.nodes]
+        self.workers = [Worker(self, node, slot) for node in self.nodes
+                        for slot in range(self.tasks_per_node)]
         for worker in self.workers:
             worker.start()
 
@@ -104,26 +334,133 @@ class Extractor(Queue):
             print('%s is DOWN' % node)
             return False
 
+    def node_slots(self, node):
+        """
+        The number of concurrent tasks a node is allowed: tasks_per_node
+        scaled by the node's rate relative to the fastest node and by its
+        success rate, and at least one. None while its breaker is open and
+        one while it is half-open.
+        :param node: URL of the SAP node.
+        :return: Number of slots
+        """
+        stats = self.node_stats[node]
+        breaker = stats.breaker()
+        if breaker != 'closed':
+            return 0 if breaker == 'open' else 1
+        rates = [s.rate for s in self.node_stats.values() if s.rate]
+        share = stats.rate / max(rates) if stats.rate and rates else 1.
+        slots = int(round(self.tasks_per_node * share *
+                          (1. - stats.error_rate)))
+        return max(1, min(self.tasks_per_node, slots))
+
+    def schedule(self, task):
+        """
+        Puts a task onto the queue, counting it against its table.
+        :param task: SAPTableTask
+        """
+        with self.schedule_lock:
+            self.in_flight[task.table] = self.in_flight.get(task.table, 0) + 1
+        self.put(task, block=False)
+
+    def avoid(self, task, node):
+        """
+        Whether a node should leave a task to other nodes: the task failed
+        on the node, and some node in rotation has not failed it.
+        :param task: SAPTableTask
+        :param node: URL of the SAP node.
+        :return: boolean
+        """
+        if node not in task.failed_nodes:
+            return False
+        return any(n not in task.failed_nodes and
+                   self.node_stats[n].breaker() != 'open'
+                   for n in self.nodes)
+
+    def retry(self, task):
+        """
+        Puts a failed task back onto the queue after a backoff, or, when it
+        is out of attempts, onto dead_letters. The task counts as in flight
+        while it waits.
+        :param task: SAPTableTask
+        """
+        if task.attempts >= self.max_attempts:
+            print('Giving up on task %s(%d - %d) after %d attempts'
+                  % (task.table.table_name, task.ri, task.ri + task.n,
+                     task.attempts))
+            with self.schedule_lock:
+                self.dead_letters.append(task)
+            self.finished(task)
+            return
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base *
+                                      2 ** (task.attempts - 1)))
+        timer = Timer(delay, self.put, args=(task,), kwargs={'block': False})
+        timer.daemon = True
+        timer.start()
+
+    def prerequisites_failed(self, task, node, e):
+        """
+        Fails a task whose table's prerequisites failed, counting it as an
+        attempt so the task is retried at most max_attempts times. A
+        TableError, e.g. unknown fields, is the table's fault rather than
+        the node's, so the node is not avoided for it.
+        :param task: SAPTableTask
+        :param node: URL of the SAP node
+        :param e: The exception raised
+        :return: Whether the node failed, boolean
+        """
+        print('Error preparing %s on %s:\n%s'
+              % (task.table.table_name, node, str(e)))
+        task.attempts += 1
+        task.status = (node, 'FAIL')
+        task.elapsed = 0.
+        if isinstance(e, TableError):
+            return False
+        task.failed_nodes.append(node)
+        return True
+
+    def pending(self):
+        """
+        :return: Number of tasks queued, executing or waiting to retry
+        """
+        with self.schedule_lock:
+            return sum(self.in_flight.values())
+
+    def finished(self, task):
+        """
+        Stops counting an executed task against its table.
+        :param task: SAPTableTask
+        """
+        with self.schedule_lock:
+            self.in_flight[task.table] -= 1
+
     def extract(self, table, parallelism=1):
         """
         Push a SAPTable <table> onto the queue, seeding <parallelism> tasks.
         :param table: SAPTable object to be extracted.
         :param parallelism: Number of tasks to put into initial queue.
         """
+        if self.ledger is not None or self.max_attempts > 1:
+            table.chunk_ids = True
+        if self.ledger is not None:
+            resumed = self.ledger.resume(table)
+            if resumed:
+                print('%s: resuming, %d tasks committed'
+                      % (table.table_name, resumed))
+        self.tables.append(table)
         for idx in range(parallelism):
             next_task = table.get_next_task()
             if next_task is not None:
-                self.put(next_task, block=False)
+                self.schedule(next_task)
             else:
                 break
-        self.tables.append(table)
 
     def blocking_status(self):
         """
-        Block workers and wait for all tables to finish.
-        Writes progress to stdout.
+        Block workers and wait for all tables to finish: until no task is
+        queued, executing or waiting to retry.
+        Writes progress to stdout, then any dead letters.
         """
-        while not all([t.complete for t in self.tables]):
+        while self.pending():
             sys.stdout.write('\r')
             for t in self.tables:
                 sys.stdout.write('[%s: %d / %d]\t'
@@ -131,19 +468,49 @@ class Extractor(Queue):
             sys.stdout.flush()
             sleep(0.5)
 
+        # Wait for the nodes' background database writes, if any, then
+        # advance the high-water marks of incremental extractions and close
+        # the ledger runs of tables that succeeded
+        for t in self.tables:
+            t.confirm_writes()
+            if self.ledger is not None:
+                for task in t.tasks:
+                    if task.write_ids:
+                        self.ledger.record(task)
+                if t.succeeded():
+                    self.ledger.close(t)
+            t.commit_watermark()
+
         sys.stdout.write('\r')
         for t in self.tables:
             out_of = t.count if t.complete else t.rmax
             sys.stdout.write('[%s: %d / %d]\t'
                              % (t.table_name, t.count, out_of))
-        sys.stdout.write('Done.')
+        sys.stdout.write('Done.\n')
+        for node in self.nodes:
+            stats = self.node_stats[node]
+            sys.stdout.write('[%s: %d tasks, %.0f rows/s, %.0f%% errors, %s]\t'
+                             % (node, stats.tasks, stats.rate or 0,
+                                100 * stats.error_rate, stats.breaker()))
+        for task in self.dead_letters:
+            sys.stdout.write('\nFailed: %s(%d - %d) after %d attempts on %s'
+                             % (task.table.table_name, task.ri,
+                                task.ri + task.n, task.attempts,
+                                ', '.join(sorted(set(task.failed_nodes)))))
+        sys.stdout.write('\n' if self.dead_letters else '')
         sys.stdout.flush()
 
     def get_next_incomplete_table_task(self):
         """
-        Returns a task from the first incomplete table in the payload.
+        Returns a task from the incomplete table with the fewest tasks in
+        flight, ties going to the table least far through its rows.
         """
-        for table in self.tables:
-            if not table.complete:
-                return table.get_next_task()
+        with self.schedule_lock:
+            tables = sorted([t for t in self.tables if not t.complete],
+                            key=lambda t: (self.in_flight.get(t, 0),
+                                           t.count / float(t.rmax or 1)))
+        for table in tables:
+            task = table.get_next_task()
+            if task is not None:
+                return task
         return None
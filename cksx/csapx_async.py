@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+asyncio variant of csapx.Extractor.
+Tasks run as coroutines on an event loop in a background thread, sharing
+one aiohttp session, so connections to the nodes are kept alive and
+pooled. Each node runs up to tasks_per_node tasks at once, and responses
+are decoded in a thread pool while other tasks wait on their nodes.
+Scheduling, retries, the ledger, extract and blocking_status are those of
+csapx.Extractor.
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from time import time
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from csapx import Extractor
+
+
+class AsyncExtractor(Extractor):
+    """
+    Extractor running its tasks as coroutines rather than in Worker
+    threads. tasks_per_node can be in the tens or hundreds: the bound is
+    the nodes, not the client.
+    """
+    DECODE_THREADS = 4  # threads decoding responses
+
+    def __init__(self, nodes=None, start=True,
+                 sqlalchemy_cnxnstr='sqlite:///db.sqlite', tasks_per_node=16,
+                 **kwargs):
+        if aiohttp is None:
+            raise ImportError('AsyncExtractor requires aiohttp')
+        self.loop = None
+        self.session = None
+        self.decoder = None
+        self.active = {}  # node: number of tasks executing
+        self.node_free = None  # asyncio.Condition, notified as tasks end
+        Extractor.__init__(self, nodes, start, sqlalchemy_cnxnstr,
+                           tasks_per_node, **kwargs)
+
+    def start(self):
+        """
+        Starts the event loop and its session on the SAP nodes that pass
+        cnxn_test.
+        """
+        self.nodes[:] = [x for x in self.nodes if self.cnxn_test(x)]
+        self.active = {node: 0 for node in self.nodes}
+        self.decoder = ThreadPoolExecutor(self.DECODE_THREADS)
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(
+            limit=0, limit_per_host=self.tasks_per_node)
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+        self.node_free = asyncio.Condition()
+
+    def close(self):
+        """
+        Closes the session and stops the event loop.
+        """
+        asyncio.run_coroutine_threadsafe(self.session.close(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.decoder.shutdown()
+
+    def put(self, task, block=True, timeout=None):
+        """
+        Starts a task on the event loop; Extractor.schedule and
+        Extractor.retry put tasks here rather than on the queue.
+        :param task: SAPTableTask
+        """
+        asyncio.run_coroutine_threadsafe(self.run_task(task), self.loop)
+
+    async def acquire(self, task):
+        """
+        Waits for a node with a free slot (see Extractor.node_slots) that
+        the task should not avoid, and takes the slot.
+        :param task: SAPTableTask
+        :return: URL of the SAP node
+        """
+        async with self.node_free:
+            while True:
+                free = [n for n in self.nodes
+                        if self.active[n] < self.node_slots(n) and
+                        not self.avoid(task, n)]
+                if free:
+                    node = min(free, key=lambda n: self.active[n] /
+                               float(self.node_slots(n)))
+                    self.active[node] += 1
+                    return node
+                # breakers reopen with time, so don't wait indefinitely
+                try:
+                    await asyncio.wait_for(self.node_free.wait(),
+                                           self.THROTTLE_SLEEP)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, node):
+        async with self.node_free:
+            self.active[node] -= 1
+            self.node_free.notify_all()
+
+    async def run_task(self, task):
+        """
+        Coroutine equivalent of Worker.run for a single task.
+        :param task: SAPTableTask
+        """
+        node = await self.acquire(task)
+        node_failed = True
+        try:
+            try:
+                # check the table prerequisites are satisfied
+                await self.loop.run_in_executor(
+                    None, task.table.prerequisites, node)
+            except Exception as e:
+                node_failed = self.prerequisites_failed(task, node, e)
+                ok = False
+            else:
+                if self.ledger is not None:
+                    self.ledger.record_partitions(task.table)
+                    self.ledger.record(task, 'running')
+                ok = await self.execute(task, node)
+        finally:
+            await self.release(node)
+        if self.ledger is not None:
+            self.ledger.record(task)
+        if node_failed:
+            self.node_stats[node].record(task.count, task.elapsed, ok)
+
+        next_task = self.get_next_incomplete_table_task()
+        if next_task is not None:
+            self.schedule(next_task)
+
+        if ok is False:
+            self.retry(task)
+        else:
+            self.finished(task)
+
+    async def execute(self, task, node):
+        """
+        Coroutine equivalent of SAPTableTask.execute.
+        :param task: SAPTableTask
+        :param node: URL of the SAP node on which to execute
+        :return: Outcome of task execution, boolean
+        """
+        req = task.request(node, self.sqlalchemy_cnxnstr)
+        if req is None:
+            task.status = (node, 'OK')
+            task.elapsed = 0.
+            return True
+        url, data = req
+
+        task.attempts += 1
+        t0 = time()
+        try:
+            async with self.session.post(url, data=json.dumps(data),
+                                         headers=task.table.headers()) as res:
+                if task.table.stream:
+                    msg = await self.read_stream(task, res)
+                else:
+                    content = await res.read()
+                    msg = await self.loop.run_in_executor(
+                        self.decoder, task.table.decode_response,
+                        res.headers.get('Content-Type', ''), content)
+            task.update(node, msg)
+        except Exception as e:
+            task.fail(node, e)
+        task.elapsed = time() - t0
+        return task.settle(node)
+
+    async def read_stream(self, task, res):
+        """
+        Coroutine equivalent of SAPTableTask.read_stream. Lines are split
+        here, as a batch's line can exceed aiohttp's line length limit.
+        :param task: SAPTableTask
+        :param res: aiohttp response to the streamed /read request
+        :return: The final status message, see SAPTableTask.end_stream
+        """
+        frames = task.new_frames()
+        msg = None
+        buf = b''
+        try:
+            async for block in res.content.iter_any():
+                lines = (buf + block).split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    if line:
+                        msg = await self.loop.run_in_executor(
+                            self.decoder, task.read_line, line, frames)
+            if buf:
+                msg = task.read_line(buf, frames)
+        except Exception:
+            await self.loop.run_in_executor(self.decoder, task.discard_frames,
+                                            frames)
+            raise
+        return await self.loop.run_in_executor(self.decoder, task.end_stream,
+                                               msg, frames)
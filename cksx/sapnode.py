@@ -1,13 +1,29 @@
 #!/usr/bin/env python2.7
 from flask import stream_with_context, request, Response
 from flask import Flask
-from time import sleep
+from time import sleep, time
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+from Queue import Queue, Empty
+import threading
+import uuid
 import sys
+import gc
+import re
 from pyrfc import Connection as SAP_cnxn
+import numpy as np
 import pandas as pd
 import sqlalchemy
 import json
+import csv
+from StringIO import StringIO
+from collections import OrderedDict
 from datetime import datetime
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 """
 
@@ -15,15 +31,556 @@ from datetime import datetime
 
 app = Flask(__name__)
 
+# Response formats; 'json' carries csv text, the others are binary and
+# carry the json status message in their schema metadata.
+FORMATS = [('json', 'application/json'),
+           ('arrow', 'application/vnd.apache.arrow.stream'),
+           ('parquet', 'application/vnd.apache.parquet')]
+
+# Connection pool limits, per set of connection details
+POOL_MAX_SIZE = 8
+POOL_IDLE_TIMEOUT = 300  # seconds
+POOL_ACQUIRE_TIMEOUT = 120  # seconds
+
+# Width of a line of the RFC's OPTIONS (where clause) table
+OPTIONS_LINE_WIDTH = 72
+
+# Most bound parameters in one multi-row INSERT (SQLite's default limit)
+MULTI_MAX_PARAMS = 999
+
+# Background database writes
+WRITE_QUEUE_SIZE = 8  # chunks waiting before /read blocks
+WRITE_THREADS = 2
+WRITE_BATCH = 4  # most chunks per transaction
+WRITE_STATUS_KEEP = 10000  # statuses remembered for /write_status
+CLEAR_CHUNK_POLL = 0.1  # seconds between checks for a chunk's queued writes
+
+# Seconds a table's DD03L metadata is reused for
+DD03L_CACHE_TTL = 3600
+
 dd03l_fields = ['FIELDNAME', 'AS4LOCAL', 'AS4VERS', 'POSITION',
                 'KEYFLAG', 'ROLLNAME', 'CHECKTABLE', 'INTTYPE',
                 'INTLEN', 'LENG']
 
 
+class TableError(ValueError):
+    """
+    An unknown table or fields, reported to the client with status 400 as
+    the table's fault rather than the node's.
+    """
+
+
 def gFIELDS(fields):
     return [{'FIELDNAME': fi} for fi in fields]
 
 
+def gOPTIONS(where):
+    """
+    Splits a where clause into OPTIONS lines of at most OPTIONS_LINE_WIDTH
+    characters, breaking between tokens and never inside a quoted literal.
+    """
+    lines = []
+    line = ''
+    for token in re.findall(r"'(?:[^']|'')*'|\S+", where or ''):
+        if line and len(line) + 1 + len(token) > OPTIONS_LINE_WIDTH:
+            lines.append({'TEXT': line})
+            line = token
+        else:
+            line = line + ' ' + token if line else token
+    if line:
+        lines.append({'TEXT': line})
+    return lines
+
+
+class ConnectionPool(object):
+    """
+    Pool of open SAP connections, keyed by connection details, so that
+    requests reuse logged-on connections instead of paying for an RFC
+    logon each.
+    Idle connections are pinged before reuse and closed once idle for
+    longer than idle_timeout. A connection that raises while in use is
+    evicted rather than returned to the pool.
+    """
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 acquire_timeout=POOL_ACQUIRE_TIMEOUT):
+        """
+        :param max_size: Maximum open connections per set of details
+        :param idle_timeout: Seconds after which idle connections close
+        :param acquire_timeout: Seconds to wait for a free connection
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.cond = threading.Condition()
+        self.idle = {}  # key: list of (connection, time released)
+        self.size = {}  # key: number of open connections, idle or in use
+        self.counters = {'opened': 0, 'reused': 0, 'evicted': 0,
+                         'expired': 0, 'waited': 0}
+
+    @staticmethod
+    def key(cnxn_details):
+        return tuple(sorted(cnxn_details.items()))
+
+    @contextmanager
+    def connection(self, cnxn_details):
+        """
+        Context manager lending a pooled connection.
+        :param cnxn_details: The SAP system's connection details
+        """
+        key = self.key(cnxn_details)
+        cnxn = self.acquire(key, cnxn_details)
+        try:
+            yield cnxn
+        except Exception:
+            self.evict(key, cnxn)
+            raise
+        self.release(key, cnxn)
+
+    def acquire(self, key, cnxn_details):
+        while True:
+            cnxn = None
+            deadline = time() + self.acquire_timeout
+            with self.cond:
+                self.expire()
+                while (not self.idle.get(key) and
+                       self.size.get(key, 0) >= self.max_size):
+                    if time() > deadline:
+                        raise RuntimeError('Timed out waiting for a pooled '
+                                           'SAP connection')
+                    self.counters['waited'] += 1
+                    self.cond.wait(1.0)
+                if self.idle.get(key):
+                    cnxn = self.idle[key].pop()[0]
+                else:
+                    self.size[key] = self.size.get(key, 0) + 1
+
+            if cnxn is None:
+                try:
+                    cnxn = SAP_cnxn(**cnxn_details)
+                except Exception:
+                    self.evict(key, None)
+                    raise
+                with self.cond:
+                    self.counters['opened'] += 1
+                return cnxn
+
+            try:
+                cnxn.ping()
+            except Exception:
+                self.evict(key, cnxn)
+                continue
+            with self.cond:
+                self.counters['reused'] += 1
+            return cnxn
+
+    def release(self, key, cnxn):
+        with self.cond:
+            self.idle.setdefault(key, []).append((cnxn, time()))
+            self.cond.notify()
+
+    def evict(self, key, cnxn):
+        if cnxn is not None:
+            try:
+                cnxn.close()
+            except Exception:
+                pass
+        with self.cond:
+            self.size[key] -= 1
+            if cnxn is not None:
+                self.counters['evicted'] += 1
+            self.cond.notify()
+
+    def expire(self):
+        """
+        Closes connections idle for longer than idle_timeout.
+        Must be called holding self.cond.
+        """
+        cutoff = time() - self.idle_timeout
+        for key, idle in self.idle.items():
+            for cnxn, released in [x for x in idle if x[1] < cutoff]:
+                idle.remove((cnxn, released))
+                self.size[key] -= 1
+                self.counters['expired'] += 1
+                try:
+                    cnxn.close()
+                except Exception:
+                    pass
+
+    def stats(self):
+        """
+        :return: Pool counters and, per system and user, the number of
+                 open and idle connections. Passwords are left out.
+        """
+        with self.cond:
+            self.expire()
+            systems = []
+            for key, size in self.size.items():
+                details = dict(key)
+                details.pop('passwd', None)
+                systems.append({'cnxn_details': details, 'open': size,
+                                'idle': len(self.idle.get(key, []))})
+            return {'max_size': self.max_size,
+                    'idle_timeout': self.idle_timeout,
+                    'counters': dict(self.counters),
+                    'systems': systems}
+
+
+cnxn_pool = ConnectionPool()
+
+engines = {}
+engines_lock = threading.Lock()
+created_tables = set()  # (sqlalchemy_cnxnstr, output_tablename)
+chunk_id_tables = {}  # (sqlalchemy_cnxnstr, output_tablename): has CHUNK_ID
+
+
+def get_engine(sqlalchemy_cnxnstr):
+    """
+    Returns the SQLAlchemy engine for a connection string, creating it
+    on first use so that its connection pool is shared across requests.
+    SQLite databases are switched to WAL journaling.
+    """
+    with engines_lock:
+        engine = engines.get(sqlalchemy_cnxnstr)
+        if engine is None:
+            engine = sqlalchemy.create_engine(sqlalchemy_cnxnstr)
+            if engine.dialect.name == 'sqlite':
+                sqlalchemy.event.listen(engine, 'connect', sqlite_pragmas)
+            engines[sqlalchemy_cnxnstr] = engine
+        return engine
+
+
+def sqlite_pragmas(dbapi_cnxn, connection_record):
+    cursor = dbapi_cnxn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def quoted_table(pd_table, conn):
+    quote = conn.dialect.identifier_preparer.quote
+    if pd_table.schema:
+        return '%s.%s' % (quote(pd_table.schema), quote(pd_table.name))
+    return quote(pd_table.name)
+
+
+def insert_executemany(pd_table, conn, keys, data_iter):
+    """
+    to_sql method inserting with the DBAPI cursor's executemany (qmark
+    paramstyle, as SQLite), inside the transaction to_sql opens.
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    cursor = conn.connection.cursor()
+    cursor.executemany('INSERT INTO %s (%s) VALUES (%s)'
+                       % (quoted_table(pd_table, conn),
+                          ', '.join(quote(k) for k in keys),
+                          ', '.join('?' * len(keys))),
+                       data_iter)
+    cursor.close()
+
+
+def insert_copy(pd_table, conn, keys, data_iter):
+    """
+    to_sql method loading with Postgres COPY FROM STDIN through a csv
+    buffer, inside the transaction to_sql opens.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in data_iter:
+        writer.writerow([x.encode('utf-8') if isinstance(x, unicode) else x
+                         for x in row])
+    buf.seek(0)
+    quote = conn.dialect.identifier_preparer.quote
+    cursor = conn.connection.cursor()
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV'
+                       % (quoted_table(pd_table, conn),
+                          ', '.join(quote(k) for k in keys)),
+                       buf)
+    cursor.close()
+
+
+# Database writers, by name, as to_sql insertion methods
+WRITERS = {'default': None,
+           'multi': 'multi',
+           'sqlite': insert_executemany,
+           'copy': insert_copy}
+
+
+def upsert_frame(df, engine, output_tablename, upsert_keys, writer, chunksize):
+    """
+    Upserts a dataframe: it is loaded into a staging table, rows of the
+    output table with a key in the staging table are deleted, and the
+    staging table is inserted, in one transaction. Within the dataframe,
+    the last row for each key wins.
+    :param upsert_keys: Key columns identifying a row
+    Other parameters as write_frame.
+    """
+    df = df.drop_duplicates(subset=upsert_keys, keep='last')
+    staging = '%s_%s' % (output_tablename, uuid.uuid4().hex[:12])
+    df.to_sql(staging, engine, if_exists='fail', chunksize=chunksize,
+              index=False, method=WRITERS[writer])
+    quote = engine.dialect.identifier_preparer.quote
+    target, source = quote(output_tablename), quote(staging)
+    columns = ', '.join(quote(c) for c in df.columns)
+    try:
+        with engine.begin() as conn:
+            conn.execute('DELETE FROM %s WHERE EXISTS (SELECT 1 FROM %s WHERE %s)'
+                         % (target, source,
+                            ' AND '.join('%s.%s = %s.%s' % (source, quote(k),
+                                                            target, quote(k))
+                                         for k in upsert_keys)))
+            conn.execute('INSERT INTO %s (%s) SELECT %s FROM %s'
+                         % (target, columns, columns, source))
+    finally:
+        engine.execute('DROP TABLE %s' % source)
+
+
+def write_frame(df, sqlalchemy_cnxnstr, output_tablename, writer='default',
+                upsert_keys=None):
+    """
+    Appends a dataframe to a database table, in one transaction.
+    :param df: Dataframe to write
+    :param sqlalchemy_cnxnstr: SQLAlchemy connection string to the database
+    :param output_tablename: Table to append to, created if missing
+    :param writer: Name of the insertion method, see WRITERS
+    :param upsert_keys: (optional) Key columns; rows replace the table's
+                        rows with the same key instead of being appended
+                        (see upsert_frame)
+    :return: Seconds taken
+    """
+    if len(df) == 0:
+        return 0.
+    engine = get_engine(sqlalchemy_cnxnstr)
+
+    # Create the table once, so concurrent writers don't race to create it
+    target = (sqlalchemy_cnxnstr, output_tablename)
+    if target not in created_tables:
+        with engines_lock:
+            if target not in created_tables:
+                exists = engine.has_table(output_tablename)
+                df.iloc[:0].to_sql(output_tablename, engine,
+                                   if_exists='append', index=False)
+                if not exists and 'CHUNK_ID' in df.columns:
+                    index_chunk_id(engine, output_tablename)
+                created_tables.add(target)
+
+    chunksize = 50000
+    if writer == 'multi':
+        chunksize = max(1, MULTI_MAX_PARAMS // len(df.columns))
+    t0 = time()
+    if upsert_keys:
+        upsert_frame(df, engine, output_tablename, upsert_keys, writer,
+                     chunksize)
+    else:
+        df.to_sql(output_tablename, engine,
+                  if_exists='append', chunksize=chunksize, index=False,
+                  method=WRITERS[writer])
+    return time() - t0
+
+
+def index_chunk_id(engine, output_tablename):
+    """
+    Indexes a table's CHUNK_ID column, so that clear_chunk finds a chunk's
+    rows without scanning the table.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    engine.execute('CREATE INDEX %s ON %s (CHUNK_ID)'
+                   % (quote('ix_%s_CHUNK_ID' % output_tablename),
+                      quote(output_tablename)))
+
+
+def chunk_id_column(sqlalchemy_cnxnstr, output_tablename, add=False):
+    """
+    Whether chunks written to a table can carry chunk ids: the table is
+    missing (write_frame creates it with an indexed CHUNK_ID column) or
+    has a CHUNK_ID column. An existing table without one, eg. from
+    extractions without chunk ids, is only altered, adding the column
+    (empty for its existing rows) and its index, if add is set.
+    :return: boolean
+    """
+    target = (sqlalchemy_cnxnstr, output_tablename)
+    if chunk_id_tables.get(target):
+        return True
+    engine = get_engine(sqlalchemy_cnxnstr)
+    with engines_lock:
+        if not engine.has_table(output_tablename):
+            return True
+        columns = [c['name'] for c in
+                   sqlalchemy.inspect(engine).get_columns(output_tablename)]
+        if 'CHUNK_ID' not in columns and add:
+            engine.execute('ALTER TABLE %s ADD COLUMN CHUNK_ID VARCHAR(64)'
+                           % engine.dialect.identifier_preparer
+                           .quote(output_tablename))
+            index_chunk_id(engine, output_tablename)
+            columns.append('CHUNK_ID')
+        chunk_id_tables[target] = 'CHUNK_ID' in columns
+    return chunk_id_tables[target]
+
+
+def clear_chunk(sqlalchemy_cnxnstr, output_tablename, chunk_id):
+    """
+    Deletes the rows an earlier attempt at a chunk wrote, so that the chunk
+    can be written again without duplicating them. Writes of the chunk
+    still queued (see queue_write), eg. from a streamed attempt that
+    failed part way, are waited for first. Only retried chunks are
+    cleared, see read.
+    :param chunk_id: Value of the chunk's CHUNK_ID column
+    """
+    while True:
+        with write_lock:
+            if not any(x.get('CHUNK_ID') == chunk_id and
+                       x['STATUS'] == 'QUEUED' for x in write_status.values()):
+                break
+        sleep(CLEAR_CHUNK_POLL)
+    engine = get_engine(sqlalchemy_cnxnstr)
+    if engine.has_table(output_tablename):
+        engine.execute(sqlalchemy.text('DELETE FROM %s WHERE CHUNK_ID = :chunk_id'
+                                       % engine.dialect.identifier_preparer
+                                       .quote(output_tablename)),
+                       chunk_id=chunk_id)
+
+
+def prepare_chunk(sqlalchemy_cnxnstr, output_tablename, chunk_id, retry,
+                  add_chunk_id):
+    """
+    Prepares the target table for a chunk with a chunk id (see read): an
+    earlier attempt's rows are cleared if the chunk is retried.
+    :return: The chunk id to write, or None if the table has no CHUNK_ID
+             column, in which case a retry can't clear earlier rows
+    """
+    if chunk_id is None or sqlalchemy_cnxnstr is None:
+        return None
+    if not chunk_id_column(sqlalchemy_cnxnstr, output_tablename,
+                           add_chunk_id):
+        print('%s has no CHUNK_ID column; writing without chunk ids'
+              % output_tablename)
+        return None
+    if retry:
+        clear_chunk(sqlalchemy_cnxnstr, output_tablename, chunk_id)
+    return chunk_id
+
+
+def write_rate(count, seconds):
+    return round(count / seconds, 1) if seconds > 0 else None
+
+
+write_queue = Queue(maxsize=WRITE_QUEUE_SIZE)
+write_status = OrderedDict()  # write id: status dict
+write_lock = threading.Lock()
+db_writers = []
+
+
+class DBWriter(threading.Thread):
+    """
+    Background thread draining write_queue, so that /read can return while
+    its chunk is written. Chunks waiting for the same table are batched,
+    up to WRITE_BATCH of them, into one transaction.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        while True:
+            jobs = [write_queue.get()]
+            while len(jobs) < WRITE_BATCH:
+                try:
+                    jobs.append(write_queue.get_nowait())
+                except Empty:
+                    break
+
+            # Group by (sqlalchemy_cnxnstr, output_tablename, writer,
+            # upsert_keys)
+            batches = OrderedDict()
+            for job in jobs:
+                batches.setdefault(job[2:], []).append(job)
+            for target, batch in batches.items():
+                self.write(batch, *target)
+
+            for _ in jobs:
+                write_queue.task_done()
+
+    def write(self, batch, sqlalchemy_cnxnstr, output_tablename, writer,
+              upsert_keys):
+        try:
+            df = pd.concat([job[1] for job in batch], ignore_index=True)
+            seconds = write_frame(df, sqlalchemy_cnxnstr, output_tablename,
+                                  writer, list(upsert_keys or []))
+            update = {'STATUS': 'OK', 'WRITER': writer,
+                      'WRITE_RATE': write_rate(len(df), seconds)}
+        except Exception, e:
+            update = {'STATUS': 'FAIL', 'ERROR': str(e)}
+        with write_lock:
+            for job in batch:
+                if job[0] in write_status:
+                    write_status[job[0]].update(update)
+
+
+def queue_write(df, sqlalchemy_cnxnstr, output_tablename, writer='default',
+                upsert_keys=None, chunk_id=None):
+    """
+    Queues a dataframe for the background DBWriters, blocking while the
+    queue is full. The writers are started on first use.
+    :param chunk_id: (optional) The chunk the dataframe belongs to, see
+                     clear_chunk
+    :return: Write id, to look up with /write_status
+    """
+    write_id = uuid.uuid4().hex
+    with write_lock:
+        if not db_writers:
+            db_writers.extend(DBWriter() for _ in range(WRITE_THREADS))
+            for db_writer in db_writers:
+                db_writer.start()
+        write_status[write_id] = {'STATUS': 'QUEUED', 'COUNT': len(df),
+                                  'CHUNK_ID': chunk_id}
+        while len(write_status) > WRITE_STATUS_KEEP:
+            write_status.popitem(last=False)
+    write_queue.put((write_id, df, sqlalchemy_cnxnstr, output_tablename,
+                     writer, tuple(upsert_keys or ())))
+    return write_id
+
+
+def negotiate_format(reqdata):
+    """
+    Picks the response format from the request's 'fmt' field, falling back
+    to its Accept header. Binary formats need pyarrow on the node.
+    :param reqdata: The request's json data; 'fmt' is popped from it
+    :return: (format name, mimetype)
+    """
+    mimetypes = dict(FORMATS)
+    fmt = reqdata.pop('fmt', None)
+    if fmt is None:
+        mimetype = request.accept_mimetypes.best_match(
+            [mt for _, mt in FORMATS], default=mimetypes['json'])
+        fmt = dict((mt, f) for f, mt in FORMATS)[mimetype]
+    if fmt not in mimetypes or (fmt != 'json' and pa is None):
+        fmt = 'json'
+    return fmt, mimetypes[fmt]
+
+
+def encode_frame(df, fmt, message):
+    """
+    Serialises a dataframe to a binary format, attaching a json message
+    to the schema metadata under 'chalk'.
+    :param df: Dataframe to serialise
+    :param fmt: 'arrow' (IPC stream) or 'parquet'
+    :param message: Dictionary of json-serialisable status / metadata
+    :return: bytes
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[b'chalk'] = json.dumps(message)
+    table = table.replace_schema_metadata(schema_metadata)
+
+    sink = pa.BufferOutputStream()
+    if fmt == 'arrow':
+        writer = pa.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+    else:
+        pq.write_table(table, sink)
+    return sink.getvalue().to_pybytes()
+
+
 @app.route('/')
 def hello_world():
     sleep(0.5)
@@ -38,13 +595,25 @@ def app_get_meta():
               (1) 'meta_csv' a dataframe written to csv and
               (2) 'vchunks' a list of field groupings that can be downloaded
                    within the sap_buffer_size limit.
+             Or, for a binary format, the metadata dataframe with
+             'vchunks' in its schema metadata.
+             Status 400 with 'ERROR' if there is no such table or fields.
     """
     print(request.method)
-    resp = get_meta(**json.loads(request.data))
-    return Response(json.dumps(resp))
+    reqdata = json.loads(request.data)
+    fmt, mimetype = negotiate_format(reqdata)
+    try:
+        resp = get_meta(fmt=fmt, **reqdata)
+    except TableError, e:
+        return Response(json.dumps({'ERROR': str(e)}), status=400)
+    if fmt == 'json':
+        return Response(json.dumps(resp))
+    return Response(encode_frame(resp.pop('meta'), fmt, resp),
+                    mimetype=mimetype)
 
 
-def get_meta(cnxn_details, table_name, fields=None, sap_buffer_size=400):
+def get_meta(cnxn_details, table_name, fields=None, sap_buffer_size=400,
+             fmt='json', fixed_width=False):
     """
     Connects to SAP system and downloads table metadata.
     :param cnxn_details: The SAP system's connection details
@@ -52,13 +621,99 @@ def get_meta(cnxn_details, table_name, fields=None, sap_buffer_size=400):
     :param fields: (optional) Only fetch a field subset of the metadata
     :param sap_buffer_size: (optional) The column-wise buffersize that
            the download RFC, BBP_RFC_READ_TABLE, uses.
+    :param fmt: (optional) Response format; for binary formats the
+           dataframe itself is returned in 'meta' instead of 'meta_csv'
+    :param fixed_width: (optional) Plan vchunks for rows read without a
+           delimiter, which otherwise takes one character per field.
     :return: metadata; a dictionary containing
-             (1) 'meta_csv' a dataframe written to csv and
+             (1) 'meta_csv' a dataframe written to csv,
              (2) 'vchunks' a list of field groupings that can be downloaded
-                 within the sap_buffer_size limit.
+                 within the sap_buffer_size limit (see plan_vchunks) and
+             (3) 'rfc_calls' the number of RFC calls per row-wise chunk.
+    """
+    meta = read_dd03l(cnxn_details, table_name)
+    if meta.empty:
+        raise TableError('%s is not in DD03L' % table_name)
+
+    # Determine column-wise chunks with sap_buffer_size
+    if fields is None:
+        fields = meta.index.tolist()
+    unknown = [f for f in fields if f.upper() not in meta.index]
+    if unknown:
+        raise TableError('%s has no fields %s'
+                         % (table_name, ', '.join(unknown)))
+    vchunks = plan_vchunks(meta, [f.upper() for f in fields],
+                           sap_buffer_size, 0 if fixed_width else 1)
+
+    # Return, passing data back as csv for json
+    metadata = {'vchunks': vchunks, 'rfc_calls': len(vchunks)}
+    if fmt == 'json':
+        metadata['meta_csv'] = meta.to_csv(encoding='utf-8')
+    else:
+        metadata['meta'] = meta.reset_index()
+    return metadata
+
+
+def plan_vchunks(meta, fields, sap_buffer_size, field_overhead):
+    """
+    Packs fields into as few column-wise chunks as fit sap_buffer_size,
+    by first-fit decreasing: the widest field first, each into the first
+    chunk with room. Fields that fit in one chunk are read in one, as
+    given. Otherwise every chunk starts with the table's key fields (bar
+    the client, MANDT, which is the same on every row), so that assemble
+    can check the chunks' rows line up; the keys are read even if not
+    among fields, and assemble drops them again.
+    :param meta: Metadata dataframe, indexed by FIELDNAME
+    :param fields: Fields to download
+    :param sap_buffer_size: Row width the RFC returns at most
+    :param field_overhead: Characters per field besides its LENG: 1 for
+                           the delimiter, 0 if fixed-width
+    :return: vchunks, a list of lists of fields, each in table order
+    """
+    width = lambda f: meta.loc[f, 'LENG'] + field_overhead
+    if sum(width(f) for f in fields) <= sap_buffer_size:
+        return [list(fields)]
+    keys = [f for f in meta.index[meta.KEYFLAG == 'X'] if f != 'MANDT']
+    key_width = sum(width(k) for k in keys)
+    if key_width > sap_buffer_size / 2:
+        keys, key_width = [], 0  # no room to repeat them
+
+    bins = []  # [free width, fields]
+    for field in sorted((f for f in fields if f not in keys),
+                        key=width, reverse=True):
+        for b in bins:
+            if width(field) <= b[0]:
+                b[0] -= width(field)
+                b[1].append(field)
+                break
+        else:
+            bins.append([sap_buffer_size - key_width - width(field), [field]])
+
+    # Fields in table order, the chunk with the first field first
+    order = dict((f, idx) for idx, f in enumerate(fields))
+    bins.sort(key=lambda b: min(order[f] for f in b[1]))
+    return [keys + sorted(b[1], key=order.get) for b in bins] or [keys]
+
+
+dd03l_cache = {}  # (system, client, table): (time, metadata dataframe)
+dd03l_lock = threading.Lock()
+
+
+def read_dd03l(cnxn_details, table_name):
+    """
+    Reads a table's fields from the SAP data dictionary table, DD03L,
+    reusing the result for DD03L_CACHE_TTL seconds.
+    :return: Metadata dataframe, indexed by FIELDNAME
     """
+    key = (cnxn_details.get('ashost'), cnxn_details.get('sysnr'),
+           cnxn_details.get('client'), table_name)
+    with dd03l_lock:
+        cached = dd03l_cache.get(key)
+    if cached is not None and time() - cached[0] < DD03L_CACHE_TTL:
+        return cached[1].copy()
+
     # Fetch metadata from SAP data dictionary table
-    with SAP_cnxn(**cnxn_details) as cnxn:
+    with cnxn_pool.connection(cnxn_details) as cnxn:
         meta_result = cnxn.call('BBP_RFC_READ_TABLE',
                                 QUERY_TABLE='DD03L',
                                 DELIMITER='|',
@@ -66,53 +721,192 @@ def get_meta(cnxn_details, table_name, fields=None, sap_buffer_size=400):
                                          % table_name}],
                                 FIELDS=gFIELDS(dd03l_fields))
         data = [map(unicode.strip, x['WA'].split('|'))
-                for x in meta_result['DATA']]
+                for x in meta_result['DATA'] or []]
         columns = [x['FIELDNAME'] for x in meta_result['FIELDS']]
 
     # Build a dataframe for convenience
     meta = pd.DataFrame(data=data, columns=columns).set_index('FIELDNAME')
     meta.LENG = meta.LENG.astype(int)
     meta = meta[meta.LENG > 0]  # drop .INCLUDE etc
+    with dd03l_lock:
+        dd03l_cache[key] = (time(), meta)
+    return meta.copy()
 
-    # Will pass data back as csv
-    meta_csv = meta.to_csv(encoding='utf-8')
 
-    # Count vchunks; determine column-wise chunks with sap_buffer_size
-    if fields is None:
-        fields = meta.index.tolist()
-    vchunks = []
-    chunksum = 0
-    chunk = []
-    for field in fields:
-        length = meta.loc[field.upper(), 'LENG']
-        chunksum += length
-        if chunksum > sap_buffer_size:
-            vchunks.append(chunk)
-            chunksum = 0
-            chunk = [field]
-        else:
-            chunk.append(field)
-    if chunk:
-        vchunks.append(chunk)
-    vchunks = vchunks
+@app.route('/read', methods=['POST'])
+def app_read():
+    """
+    Function wrapping for read and read_stream.
+    If the request sets 'stream', the chunk is streamed back in batches
+    of 'batch_size' rows as newline-delimited json (see read_stream).
+    Otherwise the format is negotiated (see negotiate_format).
+    :return: A response with 'STATUS', 'TIMESTAMP', 'COUNT' and (if keep)
+             'DATA' in the json data, or for a binary format the data
+             with the status in its schema metadata.
+    """
+    reqdata = json.loads(request.data)
+    if reqdata.pop('stream', False):
+        reqdata.pop('fmt', None)
+        return Response(stream_with_context(read_stream(**reqdata)),
+                        mimetype='application/x-ndjson')
+    fmt, mimetype = negotiate_format(reqdata)
+    if fmt == 'json':
+        return Response(read(**reqdata))
+    json_out, df = read(fmt=fmt, **reqdata)
+    return Response(encode_frame(df, fmt, json_out), mimetype=mimetype)
 
-    # Return
-    metadata = {'meta_csv': meta_csv, 'vchunks': vchunks}
-    return metadata
+
+def fetch(cnxn, table_name, vchunks, ri, n, where, delimiter='|'):
+    """
+    Downloads a row-wise chunk, looping through its column-wise chunks.
+    The rows are left unparsed; see assemble.
+    :param cnxn: Open SAP connection
+    :param table_name: The SAP table to read
+    :param vchunks: List of field groupings, one RFC call per grouping
+    :param ri: Starting row for chunk
+    :param n: Number of rows in chunk
+    :param where: Where clause
+    :param delimiter: Field delimiter, or '' for fixed-width rows
+    :return: List of (vchunk, DATA, layout) triples, empty if there are no
+             rows. For fixed-width rows the layout lists each field's
+             (offset, length) as returned in the RFC's FIELDS table,
+             otherwise it is None.
+    """
+    fetched = []
+    for vchunk in vchunks:
+        chunk_response = cnxn.call(
+            'BBP_RFC_READ_TABLE', QUERY_TABLE=table_name,
+            DELIMITER=delimiter, OPTIONS=gOPTIONS(where),
+            FIELDS=gFIELDS(vchunk), ROWCOUNT=n,
+            ROWSKIPS=ri, NO_DATA='')
+        if chunk_response['DATA'] is None:
+            # There are no rows...
+            return []
+        layout = None
+        if not delimiter:
+            layout = [(int(fi['OFFSET']), int(fi['LENGTH']))
+                      for fi in chunk_response['FIELDS']]
+        fetched.append((vchunk, chunk_response['DATA'], layout))
+    return fetched
 
 
-@app.route('/read', methods=['POST'])
-def app_read():
+def fetch_parallel(cnxn_details, table_name, vchunks, ri, n, where, workers,
+                   delimiter='|'):
+    """
+    As fetch, but makes the column-wise RFC calls concurrently, each on a
+    connection from the pool. Results keep the order of vchunks so that
+    rows join by position.
+    :param cnxn_details: The SAP system's connection details
+    :param workers: Maximum number of concurrent RFC calls
+    Other parameters as fetch.
+    :return: List of (vchunk, DATA, layout) triples, empty if there are no
+             rows
+    """
+    def fetch_vchunk(vchunk):
+        with cnxn_pool.connection(cnxn_details) as cnxn:
+            return fetch(cnxn, table_name, [vchunk], ri, n, where, delimiter)
+
+    pool = ThreadPool(max(1, min(workers, len(vchunks))))
+    try:
+        results = pool.map(fetch_vchunk, vchunks)
+    finally:
+        pool.close()
+    if not all(results):
+        return []
+    return [result[0] for result in results]
+
+
+def fetch_chunk(cnxn_details, table_name, vchunks, ri, n, where,
+                vchunk_workers=1, fixed_width=False):
+    """
+    Fetches a row-wise chunk, serially on one connection or, with
+    vchunk_workers > 1, concurrently with fetch_parallel.
+    With fixed_width the rows are requested without a delimiter.
+    """
+    delimiter = '' if fixed_width else '|'
+    if vchunk_workers > 1 and len(vchunks) > 1:
+        return fetch_parallel(cnxn_details, table_name, vchunks, ri, n, where,
+                              vchunk_workers, delimiter)
+    with cnxn_pool.connection(cnxn_details) as cnxn:
+        return fetch(cnxn, table_name, vchunks, ri, n, where, delimiter)
+
+
+def slice_fixed_width(rows, layout):
+    """
+    Slices fixed-width WA lines into columns, vectorized over the rows:
+    the lines are laid out as a 2d array of characters and each field's
+    character range is viewed back as one fixed-width string per row.
+    :param rows: The rows' DATA entries
+    :param layout: List of (offset, length) per field
+    :return: List of stripped column arrays, one per field
     """
-    Function wrapping for read.
-    :return: A response with 'metacsv' and 'vchunks' in the json data.
+    width = max(offset + length for offset, length in layout)
+    lines = np.array([x['WA'] for x in rows], dtype='U%d' % width)
+    chars = lines.view('U1').reshape(len(lines), width)
+    columns = []
+    for offset, length in layout:
+        field = np.ascontiguousarray(chars[:, offset:offset + length])
+        columns.append(np.char.strip(field.view('U%d' % length).ravel())
+                       .astype(object))
+    return columns
+
+
+def assemble(fetched, start=0, stop=None, fields=None):
+    """
+    Parses rows [start:stop] of a fetched chunk into a dataframe.
+    Each column-wise chunk's rows are split and transposed straight into
+    per-column arrays, or sliced by offset if fixed-width, and the
+    dataframe is built once from all the columns. Garbage collection is
+    paused meanwhile, as the split rows are short-lived containers that
+    would otherwise trigger repeated full collections.
+    :param fetched: List of (vchunk, DATA, layout) triples from fetch
+    :param start: First row to parse
+    :param stop: (optional) Row to stop parsing at
+    :param fields: (optional) The fields requested, in the order to return
+                   them; other fields read are dropped
+    :return: Dataframe of the chunk's rows, all fields as strings
+    Fields in more than one column-wise chunk, the keys (see plan_vchunks),
+    are kept once, after checking the chunks agree on them.
     """
-    return Response(read(**json.loads(request.data)))
+    columns = OrderedDict()
+
+    def add(field, column):
+        if field not in columns:
+            columns[field] = column
+        elif not np.array_equal(columns[field], column):
+            raise ValueError('Column-wise chunks disagree on field %s; '
+                             'rows do not line up' % field)
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for vchunk, rows, layout in fetched:
+            if layout is not None:
+                for field, column in zip(vchunk, slice_fixed_width(
+                        rows[start:stop], layout)):
+                    add(field, column)
+                continue
+            split = [x['WA'].split('|') for x in rows[start:stop]]
+            if any(len(row) != len(vchunk) for row in split):
+                raise ValueError('Delimiter found in the data of fields %s'
+                                 % ', '.join(vchunk))
+            for field, column in zip(vchunk, zip(*split)):
+                add(field, np.array(map(unicode.strip, column), dtype=object))
+            del split
+    finally:
+        if gc_enabled:
+            gc.enable()
+    if fields is not None:
+        columns = OrderedDict((f, columns[f]) for f in fields)
+    return pd.DataFrame(columns, columns=list(columns))
 
 
 def read(cnxn_details, table_name, vchunks, ri, n, where,
          sqlalchemy_cnxnstr='sqlite:////home/cks/db.sqlite',
-         output_tablename=None, keep=False):
+         output_tablename=None, keep=False, fmt='json', vchunk_workers=1,
+         fixed_width=False, writer='default', async_write=False,
+         delta_field=None, upsert_keys=None, chunk_id=None, retry=False,
+         add_chunk_id=False, fields=None):
     """
 
     :param cnxn_details:
@@ -124,56 +918,203 @@ def read(cnxn_details, table_name, vchunks, ri, n, where,
     :param sqlalchemy_cnxnstr:
     :param output_tablename:
     :param keep:
+    :param fmt: 'json' to return a json string with the data as csv,
+                otherwise (status dict, dataframe) for encode_frame
+    :param vchunk_workers: Number of column-wise chunks to fetch
+                           concurrently (see fetch_parallel)
+    :param fixed_width: Fetch rows without a delimiter and slice them by
+                        field offset (see slice_fixed_width)
+    :param writer: Database writer, see WRITERS. Its rows per second are
+                   returned in 'WRITE_RATE'.
+    :param async_write: Queue the write for the background writers and
+                        return straight away, with 'STATUS' 'QUEUED' and
+                        'WRITE_IDS' to check with /write_status.
+    :param delta_field: (optional) Field whose largest value in the chunk
+                        is returned in 'DELTA_MAX', as the next high-water
+                        mark of an incremental extraction
+    :param upsert_keys: (optional) Key columns to upsert the chunk on,
+                        see write_frame
+    :param chunk_id: (optional) Identifier of the chunk, written to a
+                     CHUNK_ID column if the target table has or gets one
+                     (see chunk_id_column)
+    :param retry: The chunk was attempted before: rows with its chunk id
+                  are deleted first, so retries don't duplicate
+    :param add_chunk_id: Add a CHUNK_ID column to an existing target table
+                         without one
+    :param fields: (optional) The fields requested, in order; see assemble
     :return:
     """
-    with SAP_cnxn(**cnxn_details) as cnxn:
-        data = None
-        fields = None
-
-        # For this row-wise chunk, loop through column-wise chunks
-        for vchunk in vchunks:
-            chunk_response = cnxn.call(
-                'BBP_RFC_READ_TABLE', QUERY_TABLE=table_name,
-                DELIMITER='|', OPTIONS=[{'TEXT': where}],
-                FIELDS=gFIELDS(vchunk), ROWCOUNT=n,
-                ROWSKIPS=ri, NO_DATA='')
-            if chunk_response['DATA'] is None:
-                # There are no rows...
+    df = assemble(fetch_chunk(cnxn_details, table_name, vchunks,
+                              ri, n, where, vchunk_workers, fixed_width),
+                  fields=fields)
+
+    output_tablename = output_tablename if output_tablename else table_name
+    chunk_id = prepare_chunk(sqlalchemy_cnxnstr, output_tablename, chunk_id,
+                             retry, add_chunk_id)
+    timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    df['TIMESTAMP'] = timestamp
+    if chunk_id is not None:
+        df['CHUNK_ID'] = chunk_id
+    count = len(df)
+
+    # write to a database
+    json_out = {'STATUS': 'FAIL', 'TIMESTAMP': timestamp, 'COUNT': count}
+    if delta_field is not None:
+        json_out['DELTA_MAX'] = df[delta_field].max() if count else None
+    if sqlalchemy_cnxnstr is not None:
+        if async_write:
+            json_out['WRITE_IDS'] = [queue_write(df, sqlalchemy_cnxnstr,
+                                                 output_tablename, writer,
+                                                 upsert_keys, chunk_id)]
+            json_out['STATUS'] = 'QUEUED'
+        else:
+            seconds = write_frame(df, sqlalchemy_cnxnstr, output_tablename,
+                                  writer, upsert_keys)
+            json_out['WRITER'] = writer
+            json_out['WRITE_RATE'] = write_rate(count, seconds)
+            json_out['STATUS'] = 'OK'
+    # return the data
+    if keep and json_out['STATUS'] == 'FAIL':
+        json_out['STATUS'] = 'OK'
+    if fmt != 'json':
+        return json_out, df if keep else df.iloc[:0]
+    if keep:
+        json_out['DATA'] = df.to_csv(index=False, encoding='utf-8')
+    return json.dumps(json_out)
+
+
+def read_stream(cnxn_details, table_name, vchunks, ri, n, where,
+                sqlalchemy_cnxnstr='sqlite:////home/cks/db.sqlite',
+                output_tablename=None, keep=False, batch_size=10000,
+                vchunk_workers=1, fixed_width=False, writer='default',
+                async_write=False, delta_field=None, upsert_keys=None,
+                chunk_id=None, retry=False, add_chunk_id=False, fields=None):
+    """
+    Streaming variant of read.
+    The chunk is fetched, parsed, written and returned batch_size rows at
+    a time, each batch with its own RFC calls (ROWSKIPS ri + start,
+    ROWCOUNT batch_size), so the node holds one batch's RFC data and
+    dataframe / csv at any point, whatever the chunk size. The database
+    skips the rows before each batch again, so chunks are best kept to a
+    few batches.
+    Yields newline-delimited json: one {'DATA': <csv>} line per batch
+    (if keep), then a final line with 'STATUS', 'TIMESTAMP' and 'COUNT'.
+    Errors are reported in the final line, as the response has already
+    started by the time they occur.
+    :param batch_size: Number of rows per streamed batch
+    Other parameters as read.
+    """
+    timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    json_out = {'STATUS': 'FAIL', 'TIMESTAMP': timestamp, 'COUNT': 0}
+    try:
+        write = sqlalchemy_cnxnstr is not None
+        output_tablename = output_tablename if output_tablename else table_name
+        chunk_id = prepare_chunk(sqlalchemy_cnxnstr, output_tablename,
+                                 chunk_id, retry, add_chunk_id)
+        seconds = 0.
+        write_ids = []
+        if delta_field is not None:
+            json_out['DELTA_MAX'] = None
+
+        start = 0
+        while not n or start < n:
+            # n = 0 reads to the end, eg. a key range
+            size = batch_size if not n else min(batch_size, n - start)
+            fetched = fetch_chunk(cnxn_details, table_name, vchunks,
+                                  ri + start, size, where, vchunk_workers,
+                                  fixed_width)
+            if not fetched:
+                break
+            df = assemble(fetched, fields=fields)
+            del fetched
+            start += len(df)
+            df['TIMESTAMP'] = timestamp
+            if chunk_id is not None:
+                df['CHUNK_ID'] = chunk_id
+            if delta_field is not None and len(df):
+                json_out['DELTA_MAX'] = max(json_out['DELTA_MAX'],
+                                            df[delta_field].max())
+            if write and async_write:
+                write_ids.append(queue_write(df, sqlalchemy_cnxnstr,
+                                             output_tablename, writer,
+                                             upsert_keys, chunk_id))
+            elif write:
+                seconds += write_frame(df, sqlalchemy_cnxnstr,
+                                       output_tablename, writer, upsert_keys)
+            if keep:
+                yield json.dumps(
+                    {'DATA': df.to_csv(index=False, encoding='utf-8')}) + '\n'
+            json_out['COUNT'] += len(df)
+            if len(df) < size:
                 break
 
-            # parse
-            chunk = [map(unicode.strip, x['WA'].split('|'))
-                     for x in chunk_response['DATA']]
-            if data is None:
-                # First pass, initialise
-                data = chunk
-                fields = vchunk
-            else:
-                # Subsequent passes, append columns
-                data = [data[idx] + chunkrow
-                        for idx, chunkrow in enumerate(chunk)]
-                fields += vchunk
-
-        # Use a dataframe for convenience
-        timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        df = pd.DataFrame(data=data, columns=fields)
-        df['TIMESTAMP'] = timestamp
-        count = len(df)
-
-        # write to a database
-        json_out = {'STATUS': 'FAIL', 'TIMESTAMP': timestamp, 'COUNT': count}
-        if sqlalchemy_cnxnstr is not None:
-            engine = sqlalchemy.create_engine(sqlalchemy_cnxnstr)
-            output_tablename = output_tablename if output_tablename else table_name
-            df.to_sql(output_tablename,
-                      engine, if_exists='append',
-                      chunksize=50000, index=False)
+        if write and async_write:
+            json_out['WRITE_IDS'] = write_ids
+            json_out['STATUS'] = 'QUEUED'
+        elif write:
+            json_out['WRITER'] = writer
+            json_out['WRITE_RATE'] = write_rate(json_out['COUNT'], seconds)
             json_out['STATUS'] = 'OK'
-        # return the data
-        if keep:
-            json_out['DATA'] = df.to_csv(index=False, encoding='utf-8')
+        elif keep:
             json_out['STATUS'] = 'OK'
-        return json.dumps(json_out)
+    except Exception, e:
+        json_out['STATUS'] = 'FAIL'
+        json_out['ERROR'] = str(e)
+    yield json.dumps(json_out) + '\n'
+
+
+@app.route('/boundaries', methods=['POST'])
+def app_sample_keys():
+    """
+    Function wrapping for sample_keys.
+    :return: Response with json data 'boundaries', a list of key values.
+    """
+    return Response(json.dumps(sample_keys(**json.loads(request.data))))
+
+
+def key_after(key_fields, values):
+    """
+    Builds an Open SQL condition for keys after values in lexicographic
+    order, e.g. for keys (K1, K2):
+    ( K1 > 'a' OR ( K1 = 'a' AND K2 > 'b' ) )
+    """
+    field = key_fields[0]
+    value = "'%s'" % unicode(values[0]).replace("'", "''")
+    if len(key_fields) == 1:
+        return '%s > %s' % (field, value)
+    return '( %s > %s OR ( %s = %s AND %s ) )' % (
+        field, value, field, value, key_after(key_fields[1:], values[1:]))
+
+
+def sample_keys(cnxn_details, table_name, key_fields, where, rmax, step):
+    """
+    Samples the key fields every step rows, as boundaries for partitioning
+    the table into ranges of its key. Only the key fields of one row are
+    read per sample, and each sample seeks past the previous one with a
+    key condition, skipping step rows from there, so sampling scans each
+    row once rather than from the start of the table per sample.
+    :param cnxn_details: The SAP system's connection details
+    :param table_name: The SAP table to sample
+    :param key_fields: The table's key fields, in key order
+    :param where: Where clause
+    :param rmax: Number of rows to sample up to
+    :param step: Rows between samples
+    :return: {'boundaries': list of sampled key values, one list per row}
+    """
+    boundaries = []
+    with cnxn_pool.connection(cnxn_details) as cnxn:
+        for _ in range(step, rmax, step):
+            conditions = ['( %s )' % where] if where else []
+            skip = step
+            if boundaries:
+                conditions.append(key_after(key_fields, boundaries[-1]))
+                skip = step - 1
+            fetched = fetch(cnxn, table_name, [key_fields], skip, 1,
+                            ' AND '.join(conditions), delimiter='')
+            if not fetched:
+                break
+            boundaries.append(assemble(fetched).iloc[0].tolist())
+    return {'boundaries': boundaries}
 
 
 @app.route('/info', methods=['POST', 'GET'])
@@ -188,17 +1129,43 @@ def info():
     reqdata = json.loads(request.data)
     cnxn_details = reqdata['cnxn_details']
     try:
-        with SAP_cnxn(**cnxn_details) as cnxn:
+        with cnxn_pool.connection(cnxn_details) as cnxn:
             cnxn.ping()
             cnxn_info = cnxn.get_connection_attributes()
             test = cnxn.call('STFC_CONNECTION', REQUTEXT='Connection Test')
-            cnxn.close()
         return json.dumps({'status': 'OK', 'data': cnxn_info})
     except Exception, e:
         resp = json.dumps({'status': 'fail', 'data': str(e)})
     return Response(resp)
 
 
+@app.route('/write_status', methods=['POST', 'GET'])
+def app_write_status():
+    """
+    Reports on background writes queued by /read with async_write.
+    Request json data (optional): 'write_ids', a list of write ids.
+    :return: Response, json data:
+               - 'queued' <number of chunks waiting to be written>,
+               - 'write_ids' <dict of write id: status dict, or null if
+                 the id is unknown>
+    """
+    reqdata = json.loads(request.data) if request.data else {}
+    with write_lock:
+        statuses = dict((write_id, write_status.get(write_id))
+                        for write_id in reqdata.get('write_ids', []))
+    return Response(json.dumps({'queued': write_queue.qsize(),
+                                'write_ids': statuses}))
+
+
+@app.route('/pool', methods=['GET'])
+def pool_stats():
+    """
+    Reports the SAP connection pool's state.
+    :return: Response, json data from ConnectionPool.stats
+    """
+    return Response(json.dumps(cnxn_pool.stats()))
+
+
 # Run the app
 if __name__ == '__main__':
     sys.argv[0]